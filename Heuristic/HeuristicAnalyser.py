@@ -1,46 +1,340 @@
 import json
 import re
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Optional, Sequence, Tuple
+
+from edit_distance import WeightedLevenshtein
+from pattern_index import MIN_WORD_LENGTH, PatternIndex
+
+MAX_TOTAL_RISK = 10.0
+# Жёсткий предел длины анализируемого текста, хвост отбрасывается
+MAX_TEXT_LENGTH = 20000
+# Фразы из нескольких слов сравниваются с окнами из стольких же слов, а также
+# на одно слово меньше (слитное написание) и больше (вставленное слово)
+EXTRA_WINDOW_WORDS = 1
+# Окна включаются только с этой длины текста: более короткие сообщения проверяются,
+# как и раньше, только сравнением всего текста и отдельными словами
+MIN_WINDOW_TEXT_LENGTH = 100
+
+
+# Символы, которые re.IGNORECASE считает равными букве, а str.lower() к ней не сводит
+CASE_EXCEPTIONS = str.maketrans({
+    "İ": "i", "ı": "i", "ſ": "s",
+    "ᲀ": "в", "ᲁ": "д", "ᲂ": "о", "ᲃ": "с", "ᲄ": "т", "ᲅ": "т", "ᲆ": "ъ",
+})
+# str.translate заметно медленнее поиска по классу символов, поэтому сначала проверяем, есть ли что менять
+CASE_EXCEPTIONS_RE = re.compile("[" + "".join(chr(code) for code in CASE_EXCEPTIONS) + "]")
+
+INLINE_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")
+ESCAPES_WITH_ARGUMENT = set("xuUN0123456789")
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    escaped = False
+    for ch in pattern:
+        if escaped:
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif in_class:
+            in_class = ch != "]"
+        elif ch == "[":
+            in_class = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "|" and depth == 0:
+            return True
+    return False
+
+
+def _skip_group(pattern: str, i: int) -> int:
+    """Индекс после скобки, закрывающей группу, которая начинается в pattern[i]"""
+    depth = 0
+    in_class = False
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if in_class:
+            in_class = ch != "]"
+        elif ch == "[":
+            in_class = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def _skip_class(pattern: str, i: int) -> int:
+    """Индекс после символьного класса, который начинается в pattern[i]"""
+    i += 1
+    if i < len(pattern) and pattern[i] == "^":
+        i += 1
+    if i < len(pattern) and pattern[i] == "]":
+        i += 1
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+        if pattern[i] == "]":
+            return i + 1
+        i += 1
+    return i
+
+
+def required_literal(pattern: str) -> Optional[str]:
+    """
+    Самый длинный буквальный фрагмент, без которого паттерн не может совпасть,
+    в нижнем регистре. None, если такой фрагмент выделить не удалось.
+    """
+    if _has_top_level_alternation(pattern) or INLINE_FLAGS_RE.match(pattern):
+        return None
+
+    runs = []
+    current = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch.isalpha() or ch.isdigit() or ch == " ":
+            following = pattern[i + 1] if i + 1 < len(pattern) else ""
+            if following in ("?", "*", "{"):
+                # Символ может отсутствовать
+                runs.append(current)
+                current = []
+            elif following == "+":
+                # Символ может повторяться — фрагмент на нём заканчивается
+                current.append(ch)
+                runs.append(current)
+                current = []
+            else:
+                current.append(ch)
+            i += 1
+            continue
+
+        runs.append(current)
+        current = []
+        if ch == "\\":
+            if pattern[i + 1:i + 2] in ESCAPES_WITH_ARGUMENT:
+                # \x41, \u0430, \N{...}, обратные ссылки — разбирать не будем
+                return None
+            i += 2
+        elif ch == "(":
+            i = _skip_group(pattern, i)
+        elif ch == "[":
+            i = _skip_class(pattern, i)
+        elif ch == "{":
+            closing = pattern.find("}", i)
+            i = len(pattern) if closing == -1 else closing + 1
+        else:
+            i += 1
+    runs.append(current)
+
+    best = max(("".join(run) for run in runs), key=len, default="")
+    if len(best.strip()) < 2:
+        return None
+    return best.translate(CASE_EXCEPTIONS).lower()
 
 
 class HeuristicFilter:
+    """
+    Регулярные выражения из patterns.json компилируются один раз. Для каждого
+    паттерна выделяется обязательный буквальный фрагмент: текст один раз
+    приводится к нижнему регистру, а регулярное выражение запускается только
+    если фрагмент в нём встречается.
+
+    Срабатывание правила из BLOCK_PATTERNS (однозначные инъекции) — окончательный
+    вердикт; правила из INJECTION_PATTERNS только отмечают текст, решение по
+    нему принимает нечёткий классификатор.
+    """
+
     def __init__(self, patterns_file: str = "patterns.json"):
         self.patterns_file = patterns_file
         with open(self.patterns_file, "r", encoding="utf-8") as f:
             data = json.load(f)
+        self.BLOCK_PATTERNS = data.get("BLOCK_PATTERNS", [])
         self.INJECTION_PATTERNS = data.get("INJECTION_PATTERNS", [])
+        self.block_patterns = frozenset(self.BLOCK_PATTERNS)
+        # Блокирующие правила проверяются первыми
+        self.compiled_patterns: List[Tuple[str, Optional[str], re.Pattern]] = [
+            (pattern, required_literal(pattern), re.compile(pattern, re.IGNORECASE))
+            for pattern in self.BLOCK_PATTERNS + self.INJECTION_PATTERNS
+        ]
+
+    def match(self, text: str) -> Optional[str]:
+        """Первый сработавший паттерн (сначала BLOCK_PATTERNS, затем INJECTION_PATTERNS) или None"""
+        if CASE_EXCEPTIONS_RE.search(text):
+            text_for_literals = text.translate(CASE_EXCEPTIONS)
+        else:
+            text_for_literals = text
+        lowered = text_for_literals.lower()
+        for pattern, literal, compiled in self.compiled_patterns:
+            if literal is not None and literal not in lowered:
+                continue
+            if compiled.search(text):
+                return pattern
+        return None
+
+    def is_blocking(self, pattern: Optional[str]) -> bool:
+        return pattern in self.block_patterns
 
     def detect_injection(self, text: str) -> bool:
-        for pattern in self.INJECTION_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
+        return self.match(text) is not None
 
 
-@dataclass
+@dataclass(frozen=True)
 class ThreatVector:
     name: str
     description: str
-    patterns: List[str]
+    patterns: Tuple[str, ...]
     weight: float = 1.0
-    risk_score: float = 0.0
+
+    @classmethod
+    def from_data(cls, vector_data: Dict) -> "ThreatVector":
+        return cls(
+            name=vector_data["name"],
+            description=vector_data["description"],
+            patterns=tuple(vector_data["patterns"]),
+            weight=vector_data.get("weight", 1.0)
+        )
+
+    def to_data(self) -> Dict:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "patterns": list(self.patterns),
+            "weight": self.weight
+        }
+
+
+@dataclass(frozen=True)
+class CompiledPattern:
+    pattern: str
+    words: Tuple[str, ...]
+    is_short: bool
+
+
+@dataclass(frozen=True)
+class VectorSet:
+    """
+    Неизменяемый снимок векторов угроз вместе со структурами для сопоставления.
+    Классификатор подменяет его целиком, поэтому запрос, начавший анализ,
+    до конца работает с одной версией.
+    """
+    version: int
+    threat_vectors: Tuple[ThreatVector, ...]
+    compiled_patterns: Tuple[Tuple[CompiledPattern, ...], ...]
+    pattern_index: PatternIndex
+    # Короткие паттерны из нескольких слов для поиска скользящим окном
+    phrase_index: PatternIndex
+    phrase_lengths: Tuple[int, ...]
+
+    @classmethod
+    def build(cls, threat_vectors: Sequence[ThreatVector], edit_distance: WeightedLevenshtein,
+              version: int) -> "VectorSet":
+        compiled_patterns = []
+        for vector in threat_vectors:
+            compiled = []
+            for pattern in vector.patterns:
+                # Текст сравнивается в нижнем регистре, паттерны приводим так же
+                lowered = pattern.lower()
+                words = tuple(lowered.split())
+                compiled.append(CompiledPattern(lowered, words, len(words) <= 2))
+            compiled_patterns.append(tuple(compiled))
+
+        pattern_index = PatternIndex(
+            (word for compiled in compiled_patterns for pattern in compiled for word in pattern.words),
+            edit_distance
+        )
+        phrases = [pattern for compiled in compiled_patterns for pattern in compiled
+                   if pattern.is_short and len(pattern.words) > 1]
+        phrase_index = PatternIndex((pattern.pattern for pattern in phrases), edit_distance)
+        phrase_lengths = tuple(sorted({len(pattern.words) for pattern in phrases}))
+        return cls(version, tuple(threat_vectors), tuple(compiled_patterns), pattern_index,
+                   phrase_index, phrase_lengths)
+
+
+@dataclass(frozen=True)
+class PatternMatch:
+    pattern: str
+    score: float
+    vector: str
+
+
+@dataclass(frozen=True)
+class AnalysisResult:
+    is_invalid: bool
+    total_risk: float
+    matched_patterns: Tuple[PatternMatch, ...]
+    vector_risks: Tuple[Tuple[str, float], ...]
+    vectors_version: int = 0
+
+    @property
+    def matched_vectors(self) -> Dict[str, float]:
+        return {name: risk for name, risk in self.vector_risks if risk > 0}
 
 
 class PromptInjectionClassifier:
     def __init__(self, vectors_file: str = "Heuristic/vectors.json", threshold: float = 0.6,
                  risk_threshold: float = 1.9, insertion_cost: int = 1,
-                 deletion_cost: int = 1, substitution_cost: int = 2):
+                 deletion_cost: int = 1, substitution_cost: int = 2, max_text_length: int = MAX_TEXT_LENGTH,
+                 vectors_data: Optional[List[Dict]] = None, version: int = 0):
+        """
+        vectors_data — готовые векторы угроз (как в get_vectors_data()) с версией
+        version; тогда vectors_file не читается и набор строится один раз
+        """
         self.vectors_file = vectors_file
+        self.max_text_length = max_text_length
         self.threshold = threshold
         self.risk_threshold = risk_threshold
         self.insertion_cost = insertion_cost
         self.deletion_cost = deletion_cost
         self.substitution_cost = substitution_cost
-        self.threat_vectors: List[ThreatVector] = []
-        self.detected_patterns: List[Tuple[str, float, str]] = []
-        self._load_vectors()
+        self.edit_distance = WeightedLevenshtein(insertion_cost, deletion_cost, substitution_cost)
+        self._update_lock = threading.Lock()
+        if vectors_data is not None:
+            threat_vectors = [ThreatVector.from_data(vector_data) for vector_data in vectors_data]
+            self._vector_set = VectorSet.build(threat_vectors, self.edit_distance, version)
+        else:
+            self._vector_set = VectorSet.build((), self.edit_distance, version=0)
+            self._load_vectors()
+
+    @property
+    def vector_set(self) -> VectorSet:
+        return self._vector_set
+
+    @property
+    def version(self) -> int:
+        return self._vector_set.version
+
+    @property
+    def threat_vectors(self) -> List[ThreatVector]:
+        return list(self._vector_set.threat_vectors)
+
+    def _swap_vectors(self, update: Callable[[List[ThreatVector]], List[ThreatVector]],
+                      version: Optional[int] = None) -> VectorSet:
+        """
+        Строит новый VectorSet из update(текущие векторы) и подменяет текущий одним
+        присваиванием. Изменения выполняются по очереди, анализ их не ждёт.
+        """
+        with self._update_lock:
+            current = self._vector_set
+            threat_vectors = update(list(current.threat_vectors))
+            if version is None:
+                version = current.version + 1
+            vector_set = VectorSet.build(threat_vectors, self.edit_distance, version)
+            self._vector_set = vector_set
+            return vector_set
 
     def _load_vectors(self):
         try:
@@ -50,15 +344,8 @@ class PromptInjectionClassifier:
             with open(self.vectors_file, "r", encoding="utf-8") as f:
                 data = json.load(f)
 
-            self.threat_vectors.clear()
-            for vector_data in data.get("vectors", []):
-                vector = ThreatVector(
-                    name=vector_data["name"],
-                    description=vector_data["description"],
-                    patterns=vector_data["patterns"],
-                    weight=vector_data.get("weight", 1.0)
-                )
-                self.threat_vectors.append(vector)
+            threat_vectors = [ThreatVector.from_data(vector_data) for vector_data in data.get("vectors", [])]
+            self._swap_vectors(lambda _: threat_vectors)
 
         except json.JSONDecodeError as e:
             raise
@@ -73,162 +360,191 @@ class PromptInjectionClassifier:
         try:
             if new_vectors_file:
                 self.vectors_file = new_vectors_file
-            old_detected_patterns = self.detected_patterns.copy()
             self._load_vectors()
-            if old_detected_patterns:
-                self.detected_patterns = []
-                for pattern, similarity, old_vector_name in old_detected_patterns:
-                    for vector in self.threat_vectors:
-                        if pattern in vector.patterns:
-                            self.detected_patterns.append((pattern, similarity, vector.name))
-                            break
             return True
         except Exception:
             return False
 
-    def update_vectors_from_data(self, vectors_data: List[Dict]) -> bool:
+    def update_vectors_from_data(self, vectors_data: List[Dict], version: Optional[int] = None) -> bool:
         try:
-            self.threat_vectors.clear()
-            for vector_data in vectors_data:
-                vector = ThreatVector(
-                    name=vector_data["name"],
-                    description=vector_data["description"],
-                    patterns=vector_data["patterns"],
-                    weight=vector_data.get("weight", 1.0)
-                )
-                self.threat_vectors.append(vector)
-            self.detected_patterns.clear()
+            threat_vectors = [ThreatVector.from_data(vector_data) for vector_data in vectors_data]
+            self._swap_vectors(lambda _: threat_vectors, version)
             return True
         except Exception:
             return False
 
+    def get_vectors_data(self) -> List[Dict]:
+        return [vector.to_data() for vector in self._vector_set.threat_vectors]
+
     def add_single_vector(self, name: str, description: str, patterns: List[str], weight: float = 1.0) -> bool:
-        try:
-            for vector in self.threat_vectors:
+        new_vector = ThreatVector(name, description, tuple(patterns), weight)
+
+        def update(threat_vectors):
+            for i, vector in enumerate(threat_vectors):
                 if vector.name == name:
-                    vector.description = description
-                    vector.patterns = patterns
-                    vector.weight = weight
+                    threat_vectors[i] = new_vector
                     break
             else:
-                vector = ThreatVector(name, description, patterns, weight)
-                self.threat_vectors.append(vector)
+                threat_vectors.append(new_vector)
+            return threat_vectors
+
+        try:
+            self._swap_vectors(update)
             return True
         except Exception:
             return False
 
     def remove_vector(self, vector_name: str) -> bool:
-        for i, vector in enumerate(self.threat_vectors):
-            if vector.name == vector_name:
-                self.threat_vectors.pop(i)
-                self.detected_patterns = [p for p in self.detected_patterns if p[2] != vector_name]
-                return True
-        return False
+        removed = False
+
+        def update(threat_vectors):
+            nonlocal removed
+            for i, vector in enumerate(threat_vectors):
+                if vector.name == vector_name:
+                    threat_vectors.pop(i)
+                    removed = True
+                    break
+            return threat_vectors
+
+        if vector_name not in (vector.name for vector in self._vector_set.threat_vectors):
+            return False
+        self._swap_vectors(update)
+        return removed
 
     def clear_vectors(self) -> None:
-        self.threat_vectors.clear()
-        self.detected_patterns.clear()
+        self._swap_vectors(lambda _: [])
 
     def levenshtein(self, str1: str, str2: str) -> int:
-        if not isinstance(str1, str) or not isinstance(str2, str):
-            raise TypeError("Оба аргумента должны быть строками")
-
-        if any(weight < 0 for weight in [self.insertion_cost, self.deletion_cost, self.substitution_cost]):
-            raise ValueError("Веса не могут быть отрицательными")
-
-        if self.insertion_cost == self.deletion_cost == self.substitution_cost == 0:
-            raise ValueError("Все веса не могут быть нулевыми одновременно")
+        return self.edit_distance.distance(str1, str2)
 
-        if str1 == str2:
-            return 0
-
-        if len(str1) == 0:
-            return len(str2) * self.insertion_cost
-
-        if len(str2) == 0:
-            return len(str1) * self.deletion_cost
-
-        if len(str1) < len(str2):
-            return self.levenshtein(str2, str1)
-
-        previous_row = [j * self.insertion_cost for j in range(len(str2) + 1)]
-
-        for i, c1 in enumerate(str1):
-            current_row = [(i + 1) * self.deletion_cost]
-            for j, c2 in enumerate(str2):
-                insertions = previous_row[j + 1] + self.deletion_cost
-                deletions = current_row[j] + self.insertion_cost
-                substitutions = previous_row[j] + (self.substitution_cost if c1 != c2 else 0)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-
-        return previous_row[-1]
-
-    def normalized_similarity(self, text: str, pattern: str) -> float:
+    def normalized_similarity(self, text: str, pattern: str, threshold: Optional[float] = None) -> float:
+        """При заданном threshold сходство ниже порога возвращается как 0.0"""
         try:
-            distance = self.levenshtein(text, pattern)
-            max_len = max(len(text), len(pattern))
-            if max_len == 0:
-                return 1.0
-            similarity = 1.0 - (distance / max_len)
-            return max(0.0, min(1.0, similarity))
+            return self.edit_distance.similarity(text, pattern, threshold)
         except Exception:
             return 0.0
 
-    def analyze_text(self, text: str) -> bool:
-        self.detected_patterns.clear()
-        text = text.lower()
+    def analyze(self, text: str) -> AnalysisResult:
+        """Анализ без изменения состояния классификатора: можно вызывать из нескольких потоков"""
+        vector_set = self._vector_set
+        threshold = self.threshold
+        text = text[:self.max_text_length].lower()
         words = text.split()
 
-        for vector in self.threat_vectors:
-            for pattern in vector.patterns:
-                if len(pattern.split()) <= 2:
-                    similarity = self.normalized_similarity(text, pattern)
-                    if similarity >= self.threshold:
-                        self.detected_patterns.append((pattern, similarity * vector.weight, vector.name))
-                pattern_words = pattern.split()
-                for pattern_word in pattern_words:
-                    if len(pattern_word) >= 3:
-                        for text_word in words:
-                            if len(text_word) >= 3:
-                                similarity = self.normalized_similarity(text_word, pattern_word)
-                                if similarity >= self.threshold:
-                                    self.detected_patterns.append(
-                                        (pattern_word, similarity * vector.weight, vector.name))
-
-        self._deduplicate_and_sort()
-        self._calculate_vector_risk()
-        return self.calculate_total_risk() > self.risk_threshold, self.calculate_total_risk()
-
-    def _deduplicate_and_sort(self):
+        # Для каждого слова паттерна — сходство с первым подходящим словом текста;
+        # последующие совпадения всё равно отбрасываются _deduplicate_and_sort
+        first_matches: Dict[str, float] = {}
+        seen_words = set()
+        for text_word in words:
+            if len(text_word) < MIN_WORD_LENGTH or text_word in seen_words:
+                continue
+            seen_words.add(text_word)
+            for pattern_word, similarity in vector_set.pattern_index.lookup(text_word, threshold):
+                first_matches.setdefault(pattern_word, similarity)
+
+        phrase_matches = self._match_phrases(vector_set, words, threshold)
+
+        detected_patterns = []
+        for vector, compiled_patterns in zip(vector_set.threat_vectors, vector_set.compiled_patterns):
+            for compiled in compiled_patterns:
+                if compiled.is_short:
+                    # Весь текст сравнивается с паттерном за O(1), если длины несовместимы;
+                    # в длинном тексте фразу находят окна из _match_phrases. Окно учитывается,
+                    # только если ни одно слово фразы не нашлось по отдельности: иначе оно не
+                    # добавляет сведений и лишь усредняет риск вектора вниз
+                    similarity = self.normalized_similarity(text, compiled.pattern, threshold)
+                    if compiled.pattern in phrase_matches and \
+                            not any(word in first_matches for word in compiled.words):
+                        similarity = max(similarity, phrase_matches[compiled.pattern])
+                    if similarity >= threshold:
+                        detected_patterns.append(PatternMatch(compiled.pattern, similarity * vector.weight,
+                                                              vector.name))
+                for pattern_word in compiled.words:
+                    similarity = first_matches.get(pattern_word)
+                    if similarity is not None:
+                        detected_patterns.append(PatternMatch(pattern_word, similarity * vector.weight, vector.name))
+
+        matched_patterns = self._deduplicate_and_sort(detected_patterns)
+        vector_risks = self._calculate_vector_risk(vector_set.threat_vectors, matched_patterns)
+        total_risk = self.calculate_total_risk(vector_risks)
+        return AnalysisResult(
+            is_invalid=total_risk > self.risk_threshold,
+            total_risk=total_risk,
+            matched_patterns=tuple(matched_patterns),
+            vector_risks=tuple(vector_risks),
+            vectors_version=vector_set.version
+        )
+
+    @staticmethod
+    def _match_phrases(vector_set: VectorSet, words: List[str], threshold: float) -> Dict[str, float]:
+        """
+        Лучшее сходство каждой фразы-паттерна с окнами текста из того же числа
+        слов (±EXTRA_WINDOW_WORDS). Окна проверяются через индекс,
+        поэтому стоимость растёт линейно с длиной текста.
+
+        Только для текстов не короче MIN_WINDOW_TEXT_LENGTH, которые по длине
+        не могут совпасть с фразой целиком.
+        """
+        matches: Dict[str, float] = {}
+        text_length = sum(len(word) for word in words) + len(words) - 1
+        if not vector_set.phrase_lengths or text_length < MIN_WINDOW_TEXT_LENGTH \
+                or vector_set.phrase_index.accepts_length(text_length, threshold):
+            return matches
+
+        sizes = sorted({max(1, length + extra) for length in vector_set.phrase_lengths
+                        for extra in range(-EXTRA_WINDOW_WORDS, EXTRA_WINDOW_WORDS + 1)})
+        seen_windows = set()
+        for size in sizes:
+            for start in range(len(words) - size + 1):
+                window = " ".join(words[start:start + size])
+                if window in seen_windows:
+                    continue
+                seen_windows.add(window)
+                for phrase, similarity in vector_set.phrase_index.lookup(window, threshold):
+                    if similarity > matches.get(phrase, 0.0):
+                        matches[phrase] = similarity
+        return matches
+
+    def analyze_text(self, text: str) -> Tuple[bool, float]:
+        result = self.analyze(text)
+        return result.is_invalid, result.total_risk
+
+    @staticmethod
+    def _deduplicate_and_sort(detected_patterns: List[PatternMatch]) -> List[PatternMatch]:
         unique_patterns = []
         seen = set()
-        for pattern in self.detected_patterns:
-            key = (pattern[0], pattern[2])
+        for match in detected_patterns:
+            key = (match.pattern, match.vector)
             if key not in seen:
-                unique_patterns.append(pattern)
+                unique_patterns.append(match)
                 seen.add(key)
-        unique_patterns.sort(key=lambda x: x[1], reverse=True)
-        self.detected_patterns = unique_patterns
-
-    def _calculate_vector_risk(self):
-        for vector in self.threat_vectors:
-            vector_patterns = [p for p in self.detected_patterns if p[2] == vector.name]
+        unique_patterns.sort(key=lambda x: x.score, reverse=True)
+        return unique_patterns
+
+    @staticmethod
+    def _calculate_vector_risk(threat_vectors: Sequence[ThreatVector],
+                               matched_patterns: List[PatternMatch]) -> List[Tuple[str, float]]:
+        vector_risks = []
+        for vector in threat_vectors:
+            vector_patterns = [p for p in matched_patterns if p.vector == vector.name]
             if vector_patterns:
-                vector.risk_score = sum(p[1] for p in vector_patterns) / len(vector_patterns) * vector.weight
+                risk_score = sum(p.score for p in vector_patterns) / len(vector_patterns) * vector.weight
             else:
-                vector.risk_score = 0.0
+                risk_score = 0.0
+            vector_risks.append((vector.name, risk_score))
+        return vector_risks
 
-    def calculate_total_risk(self) -> float:
-        if not self.detected_patterns:
-            return 0.0
-        total_risk = sum(vector.risk_score for vector in self.threat_vectors if vector.risk_score > 0)
-        return min(total_risk, 10.0)
+    @staticmethod
+    def calculate_total_risk(vector_risks: Sequence[Tuple[str, float]]) -> float:
+        total_risk = sum((risk for _, risk in vector_risks if risk > 0), 0.0)
+        return min(total_risk, MAX_TOTAL_RISK)
 
     def get_vector_stats(self) -> Dict:
+        vector_set = self._vector_set
         return {
-            "total_vectors": len(self.threat_vectors),
-            "total_patterns": sum(len(v.patterns) for v in self.threat_vectors),
+            "version": vector_set.version,
+            "total_vectors": len(vector_set.threat_vectors),
+            "total_patterns": sum(len(v.patterns) for v in vector_set.threat_vectors),
             "vectors": [
                 {
                     "name": v.name,
@@ -236,7 +552,7 @@ class PromptInjectionClassifier:
                     "weight": v.weight,
                     "description": v.description
                 }
-                for v in self.threat_vectors
+                for v in vector_set.threat_vectors
             ]
         }
 
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from HeuristicAnalyser import AnalysisResult, PromptInjectionClassifier, VectorSet
+from verdict_cache import VerdictCache
+
+TEXT_POLICIES = ("truncate", "reject")
+
+# Классификатор процесса-воркера, создаётся один раз в _init_worker
+_worker_classifier: Optional[PromptInjectionClassifier] = None
+
+
+def _init_worker(classifier_kwargs: Dict, vectors_data: List[Dict], version: int) -> None:
+    global _worker_classifier
+    _worker_classifier = PromptInjectionClassifier(**classifier_kwargs, vectors_data=vectors_data, version=version)
+
+
+def _ping() -> int:
+    return _worker_classifier.version
+
+
+def _analyze_chunk(texts: List[str]) -> List[AnalysisResult]:
+    return [_worker_classifier.analyze(text) for text in texts]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class TextTooLongError(Exception):
+    pass
+
+
+class BatchTooLargeError(Exception):
+    pass
+
+
+class AnalysisPool:
+    """
+    Выполнение analyze вне event loop.
+
+    workers=0 — анализ в одном потоке рядом с event loop (классификатор общий,
+    он не хранит состояние между вызовами); workers>0 — пул процессов, у
+    каждого воркера свой классификатор. Одновременно в работе не больше
+    max_pending текстов, остальные запросы получают QueueFullError.
+
+    self.classifier в основном процессе — источник векторов угроз. После его
+    изменения refresh() поднимает новый пул процессов с новой версией, ждёт
+    готовности воркеров и только затем подменяет пул; старый дорабатывает
+    уже принятые задачи.
+    """
+
+    def __init__(self, classifier_kwargs: Dict, workers: Optional[int] = None, max_pending: int = 256,
+                 max_text_length: int = 4096, text_policy: str = "truncate", max_batch_size: int = 64,
+                 cache: Optional[VerdictCache] = None):
+        if text_policy not in TEXT_POLICIES:
+            raise ValueError(f"Неизвестная политика длинных текстов: {text_policy}")
+
+        self.classifier_kwargs = classifier_kwargs
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending
+        self.max_text_length = max_text_length
+        self.text_policy = text_policy
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+        self.pending = 0
+
+        self.classifier: Optional[PromptInjectionClassifier] = None
+        self.executor: Optional[Executor] = None
+        self.executor_version = 0
+        self.executor_vector_set: Optional[VectorSet] = None
+        self._refresh_lock = threading.Lock()
+
+    def start(self) -> None:
+        self.classifier = PromptInjectionClassifier(**self.classifier_kwargs)
+        if self.workers > 0:
+            self.executor, self.executor_vector_set = self._new_process_pool()
+            self.executor_version = self.executor_vector_set.version
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis")
+            self.executor_version = self.classifier.version
+
+    @property
+    def serving_version(self) -> int:
+        """Версия векторов, которой сейчас отвечают воркеры"""
+        if self.workers == 0:
+            return self.classifier.version
+        return self.executor_version
+
+    @property
+    def serving_vector_set(self) -> VectorSet:
+        """Набор векторов, которым сейчас отвечают воркеры"""
+        if self.workers == 0:
+            return self.classifier.vector_set
+        return self.executor_vector_set
+
+    def _new_process_pool(self):
+        vector_set = self.classifier.vector_set
+        vectors_data = [vector.to_data() for vector in vector_set.threat_vectors]
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.classifier_kwargs, vectors_data, vector_set.version)
+        )
+        # Прогрев: воркеры создаются и строят индекс до того, как пул попадёт в работу
+        wait([executor.submit(_ping) for _ in range(self.workers)])
+        return executor, vector_set
+
+    def refresh(self) -> int:
+        """Синхронизирует воркеры с self.classifier; блокирующий вызов, не для event loop"""
+        with self._refresh_lock:
+            if self.workers == 0:
+                # Потоковый режим работает прямо с self.classifier
+                self.executor_version = self.classifier.version
+            elif self.executor_version != self.classifier.version:
+                executor, vector_set = self._new_process_pool()
+                old_executor, self.executor = self.executor, executor
+                self.executor_vector_set = vector_set
+                self.executor_version = vector_set.version
+                if old_executor is not None:
+                    old_executor.shutdown(wait=False)
+            if self.cache is not None:
+                # Записи старых версий уже не найдутся, освобождаем память сразу
+                self.cache.clear()
+            return self.executor_version
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def prepare_text(self, text: str) -> str:
+        if len(text) <= self.max_text_length:
+            return text
+        if self.text_policy == "reject":
+            raise TextTooLongError(f"Текст длиннее {self.max_text_length} символов")
+        return text[:self.max_text_length]
+
+    def _chunks(self, texts: List[str]) -> List[List[str]]:
+        parts = max(1, min(self.workers, len(texts)))
+        size = -(-len(texts) // parts)
+        return [texts[i:i + size] for i in range(0, len(texts), size)]
+
+    def _submit(self, loop: asyncio.AbstractEventLoop, func, *args) -> asyncio.Future:
+        while True:
+            executor = self.executor
+            try:
+                return loop.run_in_executor(executor, func, *args)
+            except RuntimeError:
+                # refresh() успел остановить пул между чтением и отправкой задачи
+                if executor is self.executor:
+                    raise
+
+    def _analyze_local(self, texts: List[str]) -> List[AnalysisResult]:
+        return [self.classifier.analyze(text) for text in texts]
+
+    async def analyze(self, texts: List[str]) -> List[AnalysisResult]:
+        if len(texts) > self.max_batch_size:
+            raise BatchTooLargeError(f"В пакете больше {self.max_batch_size} текстов")
+
+        texts = [self.prepare_text(text) for text in texts]
+        results: List[Optional[AnalysisResult]] = [None] * len(texts)
+        if self.cache is not None:
+            version = self.serving_version
+            results = [self.cache.get(text, version) for text in texts]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+
+        if self.pending + len(missing) > self.max_pending:
+            raise QueueFullError("Очередь анализа переполнена")
+
+        missing_texts = [texts[i] for i in missing]
+        self.pending += len(missing)
+        try:
+            loop = asyncio.get_running_loop()
+            if self.workers == 0:
+                chunks = [await self._submit(loop, self._analyze_local, missing_texts)]
+            else:
+                chunks = await asyncio.gather(*[
+                    self._submit(loop, _analyze_chunk, chunk)
+                    for chunk in self._chunks(missing_texts)
+                ])
+        finally:
+            self.pending -= len(missing)
+
+        computed = [result for chunk in chunks for result in chunk]
+        for i, result in zip(missing, computed):
+            results[i] = result
+            if self.cache is not None:
+                self.cache.put(texts[i], result)
+        return results
@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from analysis_pool import AnalysisPool, BatchTooLargeError
+from HeuristicAnalyser import AnalysisResult, HeuristicFilter, MAX_TOTAL_RISK
+
+STAGES = ("regex", "preprocess", "fuzzy", "semantic")
+
+
+@dataclass(frozen=True)
+class Verdict:
+    is_invalid: bool
+    valid_stat: float
+    stage: str
+    vectors_version: int
+    matched_rule: Optional[str] = None
+    matched_vectors: Dict[str, float] = field(default_factory=dict)
+    semantic_score: Optional[float] = None
+
+
+class CascadeMetrics:
+    """Сколько текстов дошло до каждой ступени, сколько она решила сама и за какое время"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {name: {"calls": 0, "invalid": 0, "valid": 0, "escalated": 0, "seconds": 0.0}
+                        for name in STAGES}
+
+    def record(self, stage: str, calls: int, invalid: int, valid: int, escalated: int, seconds: float) -> None:
+        with self._lock:
+            counters = self._stages[stage]
+            counters["calls"] += calls
+            counters["invalid"] += invalid
+            counters["valid"] += valid
+            counters["escalated"] += escalated
+            counters["seconds"] += seconds
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {}
+            for name, counters in self._stages.items():
+                calls = counters["calls"]
+                decided = counters["invalid"] + counters["valid"]
+                result[name] = {
+                    "calls": calls,
+                    "decided_invalid": counters["invalid"],
+                    "decided_valid": counters["valid"],
+                    "escalated": counters["escalated"],
+                    "hit_ratio": decided / calls if calls else 0.0,
+                    "avg_latency_ms": counters["seconds"] / calls * 1000 if calls else 0.0
+                }
+            return result
+
+
+class ObfuscationStage:
+    """
+    Дорогая ступень на основе service_scripts/prompt_preprocessing.py: текст
+    деобфусцируется и заново проверяется нечётким классификатором, а сходство
+    эмбеддингов исходного и деобфусцированного текста показывает, не прячет ли
+    обфускация другой смысл. Исходный текст приводится к тому же регистру и
+    пробелам, поэтому необфусцированные тексты оцениваются без эмбеддингов.
+    """
+
+    name = "semantic"
+
+    def __init__(self, analysis_pool: AnalysisPool, min_similarity: float = 0.85):
+        # Импорт тянет NLTK, pymorphy3 и облачный эмбеддер, поэтому только при включённой ступени
+        from service_scripts import normalization, prompt_preprocessing
+
+        self.normalization = normalization
+        self.preprocessing = prompt_preprocessing
+        self.analysis_pool = analysis_pool
+        self.min_similarity = min_similarity
+
+    def stats(self) -> Dict:
+        return self.preprocessing.obfuscation_scorer.stats()
+
+    async def evaluate(self, texts: List[str],
+                       fuzzy_results: List[AnalysisResult]) -> List[Tuple[bool, float, float]]:
+        """(is_invalid, риск, сходство эмбеддингов) для каждого текста"""
+        loop = asyncio.get_running_loop()
+        deobfuscated = [self.preprocessing.prepare_text(text) for text in texts]
+        pairs = [(self.normalization.cosmetic_normalize(raw), deobf) for raw, deobf in zip(texts, deobfuscated)]
+        scores = await loop.run_in_executor(None, self.preprocessing.obf_score_batch, pairs)
+        deobf_results = await self.analysis_pool.analyze(deobfuscated)
+
+        risk_threshold = self.analysis_pool.classifier.risk_threshold
+        verdicts = []
+        for fuzzy, deobf, score in zip(fuzzy_results, deobf_results, scores):
+            risk = max(fuzzy.total_risk, deobf.total_risk)
+            verdicts.append((risk > risk_threshold or score["sim"] < self.min_similarity, risk, score["sim"]))
+        return verdicts
+
+
+class EmbeddingStage:
+    """
+    Семантическая ступень на SemanticMatcher: текст недопустим, если его
+    косинусное сходство хотя бы с одним паттерном не ниже min_score. Матрицу
+    паттернов строит refresh() после обновления векторов, а запросы до её
+    готовности сравниваются с прежней.
+    """
+
+    name = "semantic"
+
+    def __init__(self, analysis_pool: AnalysisPool, matcher, min_score: float = 0.6):
+        self.analysis_pool = analysis_pool
+        self.matcher = matcher
+        self.min_score = min_score
+
+    def refresh(self) -> int:
+        """Матрица для версии векторов, которой отвечают воркеры; блокирующий вызов, не для event loop"""
+        return self.matcher.build(self.analysis_pool.serving_vector_set).version
+
+    async def evaluate(self, texts: List[str],
+                       fuzzy_results: List[AnalysisResult]) -> List[Tuple[bool, float, float]]:
+        loop = asyncio.get_running_loop()
+        matches = await loop.run_in_executor(None, self.matcher.match, texts)
+        return [(match.best_score >= self.min_score, fuzzy.total_risk, match.best_score)
+                for fuzzy, match in zip(fuzzy_results, matches)]
+
+
+class DetectionCascade:
+    """
+    regex → fuzzy → semantic. Срабатывание блокирующего регулярного выражения
+    (HeuristicFilter.BLOCK_PATTERNS) сразу признаёт текст недопустимым; остальные
+    правила только записываются в matched_rule, а текст идёт дальше. Нечёткий
+    классификатор решает сам, если риск вне полосы
+    [risk_threshold - lower_margin, risk_threshold + upper_margin]; тексты
+    внутри полосы уходят на семантическую ступень, а без неё решаются
+    обычным сравнением с risk_threshold.
+
+    preprocessor (например, prompt_preprocessing.preprocess_batch) переписывает
+    тексты перед нечёткой ступенью; регулярные выражения и семантическая
+    ступень видят исходный текст.
+    """
+
+    def __init__(self, heuristic_filter: Optional[HeuristicFilter], analysis_pool: AnalysisPool,
+                 semantic_stage=None, fuzzy_lower_margin: float = 0.5, fuzzy_upper_margin: float = 0.5,
+                 preprocessor: Optional[Callable[[List[str]], List[str]]] = None):
+        self.heuristic_filter = heuristic_filter
+        self.analysis_pool = analysis_pool
+        self.semantic_stage = semantic_stage
+        self.preprocessor = preprocessor
+        self.fuzzy_lower_margin = fuzzy_lower_margin
+        self.fuzzy_upper_margin = fuzzy_upper_margin
+        self.metrics = CascadeMetrics()
+
+    @staticmethod
+    def _fuzzy_verdict(result: AnalysisResult, rule: Optional[str] = None) -> Verdict:
+        return Verdict(
+            is_invalid=result.is_invalid,
+            valid_stat=result.total_risk,
+            stage="fuzzy",
+            vectors_version=result.vectors_version,
+            matched_rule=rule,
+            matched_vectors=result.matched_vectors
+        )
+
+    async def evaluate(self, texts: List[str]) -> List[Verdict]:
+        if len(texts) > self.analysis_pool.max_batch_size:
+            raise BatchTooLargeError(f"В пакете больше {self.analysis_pool.max_batch_size} текстов")
+        texts = [self.analysis_pool.prepare_text(text) for text in texts]
+        verdicts: List[Optional[Verdict]] = [None] * len(texts)
+
+        # 1. Регулярные выражения: окончательный вердикт только у блокирующих правил
+        remaining = list(range(len(texts)))
+        rules: List[Optional[str]] = [None] * len(texts)
+        if self.heuristic_filter is not None:
+            start = time.perf_counter()
+            version = self.analysis_pool.serving_version
+            remaining = []
+            for i, text in enumerate(texts):
+                rules[i] = self.heuristic_filter.match(text)
+                if self.heuristic_filter.is_blocking(rules[i]):
+                    verdicts[i] = Verdict(True, MAX_TOTAL_RISK, "regex", version, matched_rule=rules[i])
+                else:
+                    remaining.append(i)
+            hits = len(texts) - len(remaining)
+            self.metrics.record("regex", len(texts), hits, 0, len(remaining), time.perf_counter() - start)
+
+        if not remaining:
+            return verdicts
+
+        fuzzy_texts = [texts[i] for i in remaining]
+        if self.preprocessor is not None:
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            max_length = self.analysis_pool.max_text_length
+            fuzzy_texts = [text[:max_length] for text in
+                           await loop.run_in_executor(None, self.preprocessor, fuzzy_texts)]
+            self.metrics.record("preprocess", len(fuzzy_texts), 0, 0, len(fuzzy_texts),
+                                time.perf_counter() - start)
+
+        # 2. Нечёткое сопоставление с векторами угроз
+        start = time.perf_counter()
+        results = await self.analysis_pool.analyze(fuzzy_texts)
+        risk_threshold = self.analysis_pool.classifier.risk_threshold
+        lower = risk_threshold - self.fuzzy_lower_margin
+        upper = risk_threshold + self.fuzzy_upper_margin
+
+        uncertain: List[Tuple[int, AnalysisResult]] = []
+        invalid = valid = 0
+        for i, result in zip(remaining, results):
+            if self.semantic_stage is not None and lower <= result.total_risk <= upper:
+                uncertain.append((i, result))
+                continue
+            verdicts[i] = self._fuzzy_verdict(result, rules[i])
+            if result.is_invalid:
+                invalid += 1
+            else:
+                valid += 1
+        self.metrics.record("fuzzy", len(remaining), invalid, valid, len(uncertain), time.perf_counter() - start)
+
+        if not uncertain:
+            return verdicts
+
+        # 3. Семантическая ступень только для неуверенной полосы
+        start = time.perf_counter()
+        semantic = await self.semantic_stage.evaluate([texts[i] for i, _ in uncertain],
+                                                      [result for _, result in uncertain])
+        invalid = valid = 0
+        for (i, result), (is_invalid, risk, score) in zip(uncertain, semantic):
+            verdicts[i] = Verdict(
+                is_invalid=is_invalid,
+                valid_stat=risk,
+                stage="semantic",
+                vectors_version=result.vectors_version,
+                matched_rule=rules[i],
+                matched_vectors=result.matched_vectors,
+                semantic_score=score
+            )
+            if is_invalid:
+                invalid += 1
+            else:
+                valid += 1
+        self.metrics.record("semantic", len(uncertain), invalid, valid, 0, time.perf_counter() - start)
+        return verdicts
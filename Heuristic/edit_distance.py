@@ -0,0 +1,121 @@
+from typing import Optional
+
+
+class WeightedLevenshtein:
+    """
+    Взвешенное расстояние Левенштейна с отсечением по максимальному расстоянию.
+
+    Результаты совпадают с полной таблицей динамического программирования
+    PromptInjectionClassifier.levenshtein: более длинная строка всегда
+    приводится к более короткой, удаление её символа стоит deletion_cost,
+    вставка символа короткой строки — insertion_cost.
+    """
+
+    def __init__(self, insertion_cost: int = 1, deletion_cost: int = 1, substitution_cost: int = 2):
+        if any(weight < 0 for weight in [insertion_cost, deletion_cost, substitution_cost]):
+            raise ValueError("Веса не могут быть отрицательными")
+
+        if insertion_cost == deletion_cost == substitution_cost == 0:
+            raise ValueError("Все веса не могут быть нулевыми одновременно")
+
+        self.insertion_cost = insertion_cost
+        self.deletion_cost = deletion_cost
+        self.substitution_cost = substitution_cost
+
+    @staticmethod
+    def max_distance(threshold: float, max_len: int) -> int:
+        """Расстояние, выше которого 1 - d / max_len гарантированно меньше threshold"""
+        # +1 — запас на округление float, итоговое сравнение делает вызывающий код
+        return int((1.0 - threshold) * max_len) + 1
+
+    def similarity(self, text: str, pattern: str, threshold: Optional[float] = None) -> float:
+        """1 - d / max_len; при заданном threshold сходство ниже порога возвращается как 0.0"""
+        max_len = max(len(text), len(pattern))
+        if max_len == 0:
+            return 1.0
+        max_distance = None
+        if threshold is not None:
+            max_distance = self.max_distance(threshold, max_len)
+        distance = self.bounded_distance(text, pattern, max_distance)
+        if max_distance is not None and distance > max_distance:
+            return 0.0
+        similarity = 1.0 - (distance / max_len)
+        return max(0.0, min(1.0, similarity))
+
+    def distance(self, str1: str, str2: str) -> int:
+        return self.bounded_distance(str1, str2, None)
+
+    def bounded_distance(self, str1: str, str2: str, max_distance: Optional[int]) -> int:
+        """
+        Точное расстояние, если оно не больше max_distance, иначе max_distance + 1.
+        max_distance=None отключает отсечение.
+        """
+        if not isinstance(str1, str) or not isinstance(str2, str):
+            raise TypeError("Оба аргумента должны быть строками")
+
+        if str1 == str2:
+            return 0
+
+        if len(str1) == 0:
+            return self._cut(len(str2) * self.insertion_cost, max_distance)
+
+        if len(str2) == 0:
+            return self._cut(len(str1) * self.deletion_cost, max_distance)
+
+        if len(str1) < len(str2):
+            str1, str2 = str2, str1
+
+        ins = self.insertion_cost
+        dele = self.deletion_cost
+        sub = self.substitution_cost
+        n, m = len(str1), len(str2)
+        skew = n - m
+
+        if max_distance is None:
+            band = n + m
+        else:
+            # Любой путь делает не меньше skew удалений; каждый шаг за пределы
+            # диагоналей [0, skew] добавляет пару вставка + удаление.
+            base = skew * dele
+            if base > max_distance:
+                return max_distance + 1
+            if ins + dele > 0:
+                band = int((max_distance - base) // (ins + dele))
+            else:
+                band = n + m
+
+        inf = float("inf")
+        previous_row = [j * ins if j <= band else inf for j in range(m + 1)]
+
+        for i in range(1, n + 1):
+            c1 = str1[i - 1]
+            j_lo = max(0, i - skew - band)
+            j_hi = min(m, i + band)
+
+            current_row = [inf] * (m + 1)
+            if j_lo == 0:
+                current_row[0] = i * dele
+                j_lo_inner = 1
+            else:
+                j_lo_inner = j_lo
+
+            left = current_row[j_lo_inner - 1]
+            for j in range(j_lo_inner, j_hi + 1):
+                insertions = previous_row[j] + dele
+                deletions = left + ins
+                substitutions = previous_row[j - 1] + (sub if c1 != str2[j - 1] else 0)
+                left = min(insertions, deletions, substitutions)
+                current_row[j] = left
+
+            if max_distance is not None and min(current_row[j_lo:j_hi + 1]) > max_distance:
+                return max_distance + 1
+
+            previous_row = current_row
+
+        return self._cut(previous_row[m], max_distance)
+
+    @staticmethod
+    def _cut(distance, max_distance: Optional[int]):
+        if max_distance is not None and distance > max_distance:
+            return max_distance + 1
+        return distance
@@ -1,9 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+import hmac
+import os
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from pydantic import BaseModel
 import requests
-from HeuristicAnalyser import PromptInjectionClassifier
+from analysis_pool import AnalysisPool, BatchTooLargeError, QueueFullError, TextTooLongError
+from cascade import DetectionCascade, EmbeddingStage, ObfuscationStage
+from HeuristicAnalyser import HeuristicFilter
+from verdict_cache import VerdictCache
 
-classifier = PromptInjectionClassifier(
+CLASSIFIER_KWARGS = dict(
     vectors_file="vectors.json",
     threshold=0.7,
     risk_threshold=1.5,
@@ -12,22 +19,200 @@ classifier = PromptInjectionClassifier(
     substitution_cost=1
 )
 
+# Первая, быстрая ступень: регулярные выражения за один проход по тексту
+heuristic_filter = HeuristicFilter(patterns_file="patterns.json")
+
+# VALID_WORKERS=0 — анализ в потоке основного процесса, по умолчанию процессов по числу ядер
+analysis_pool = AnalysisPool(
+    CLASSIFIER_KWARGS,
+    workers=int(os.environ["VALID_WORKERS"]) if "VALID_WORKERS" in os.environ else None,
+    max_pending=int(os.getenv("VALID_MAX_PENDING", "256")),
+    max_text_length=int(os.getenv("VALID_MAX_TEXT_LENGTH", "4096")),
+    text_policy=os.getenv("VALID_LONG_TEXT_POLICY", "truncate"),
+    max_batch_size=int(os.getenv("VALID_MAX_BATCH_SIZE", "64")),
+    cache=VerdictCache(max_size=int(os.getenv("VALID_CACHE_SIZE", "10000")))
+)
+
+# Каскад: блокирующие регулярные выражения решают сами, остальные только отмечают
+# текст в matched_rule; нечёткий классификатор — вне полосы
+# неуверенности вокруг risk_threshold, полоса уходит на семантическую ступень.
+# VALID_SEMANTIC_STAGE=obfuscation включает ступень на service_scripts/prompt_preprocessing.py,
+# embedding — сравнение эмбеддингов с матрицей паттернов (бэкенд VALID_EMBEDDING_BACKEND).
+# Зависимости обеих ступеней и VALID_PREPROCESS — в requirements-semantic.txt
+SEMANTIC_STAGE = os.getenv("VALID_SEMANTIC_STAGE", "none")
+if SEMANTIC_STAGE not in ("none", "obfuscation", "embedding"):
+	raise ValueError(f"Неизвестная семантическая ступень: {SEMANTIC_STAGE}")
+
+# VALID_PREPROCESS: none, deobfuscate (однопроходная нормализация) или lemmatize
+# (нормализация и лемматизация с LRU-кэшем лемм) перед нечёткой ступенью
+PREPROCESS = os.getenv("VALID_PREPROCESS", "none")
+if PREPROCESS not in ("none", "deobfuscate", "lemmatize"):
+	raise ValueError(f"Неизвестный режим предобработки: {PREPROCESS}")
+
+cascade = DetectionCascade(
+	heuristic_filter if os.getenv("VALID_REGEX_STAGE", "1") != "0" else None,
+	analysis_pool,
+	fuzzy_lower_margin=float(os.getenv("VALID_FUZZY_LOWER_MARGIN", "0.5")),
+	fuzzy_upper_margin=float(os.getenv("VALID_FUZZY_UPPER_MARGIN", "0.5"))
+)
+
+# Без VALID_ADMIN_TOKEN административные эндпоинты отключены
+ADMIN_TOKEN = os.getenv("VALID_ADMIN_TOKEN")
+
 app = FastAPI(title="Validator", docs_url=None, redoc_url=None, openapi_url=None)
 
 class ValidRequest(BaseModel):
 	text: str
 
+class ValidBatchRequest(BaseModel):
+	texts: List[str]
+
+class VectorData(BaseModel):
+	description: str
+	patterns: List[str]
+	weight: float = 1.0
+
+class NamedVectorData(VectorData):
+	name: str
+
+class VectorSetData(BaseModel):
+	vectors: List[NamedVectorData]
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+	# Сравнение за постоянное время; байты, потому что для str compare_digest принимает только ASCII
+	if not ADMIN_TOKEN or not hmac.compare_digest((x_admin_token or "").encode(), ADMIN_TOKEN.encode()):
+		raise HTTPException(status_code=403, detail="Forbidden")
+
+
+def to_response(verdict):
+	return {
+	"is_invalid": verdict.is_invalid,
+	"valid_stat": verdict.valid_stat,
+	"matched_vectors": verdict.matched_vectors,
+	"matched_rule": verdict.matched_rule,
+	"stage": verdict.stage,
+	"semantic_score": verdict.semantic_score,
+	"vectors_version": verdict.vectors_version
+	}
+
+
+async def run_analysis(texts):
+	try:
+		verdicts = await cascade.evaluate(texts)
+		return [to_response(verdict) for verdict in verdicts]
+	except (TextTooLongError, BatchTooLargeError) as e:
+		raise HTTPException(status_code=413, detail=str(e))
+	except QueueFullError as e:
+		raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.on_event("startup")
+def on_startup():
+	analysis_pool.start()
+	if PREPROCESS != "none" or SEMANTIC_STAGE == "obfuscation":
+		from service_scripts import prompt_preprocessing
+
+		# Прогрев: pymorphy3 и эмбеддер загружаются до первого запроса, а не на нём
+		if os.getenv("VALID_PREPROCESS_WARMUP", "1") != "0":
+			prompt_preprocessing.warm_up(embedder=SEMANTIC_STAGE == "obfuscation")
+	if PREPROCESS != "none":
+		if PREPROCESS == "deobfuscate":
+			cascade.preprocessor = lambda texts: [prompt_preprocessing.prepare_text(text) for text in texts]
+		else:
+			cascade.preprocessor = prompt_preprocessing.preprocess_batch
+	if SEMANTIC_STAGE == "obfuscation":
+		cascade.semantic_stage = ObfuscationStage(
+			analysis_pool, min_similarity=float(os.getenv("VALID_OBF_MIN_SIMILARITY", "0.85")))
+	elif SEMANTIC_STAGE == "embedding":
+		from semantic_matcher import SemanticMatcher, make_backend
+
+		matcher = SemanticMatcher(
+			make_backend(os.getenv("VALID_EMBEDDING_BACKEND", "yandex")),
+			cache_dir=os.getenv("VALID_EMBEDDING_CACHE_DIR", "embedding_cache"),
+			top_k=int(os.getenv("VALID_SEMANTIC_TOP_K", "3"))
+		)
+		semantic_stage = EmbeddingStage(
+			analysis_pool, matcher, min_score=float(os.getenv("VALID_SEMANTIC_MIN_SCORE", "0.6")))
+		semantic_stage.refresh()
+		cascade.semantic_stage = semantic_stage
+
+@app.on_event("shutdown")
+def on_shutdown():
+	analysis_pool.shutdown()
+
 
 @app.post("/valid/")
 async def analyze_text(user_message: ValidRequest):
-	is_invalid, valid_stat = classifier.analyze_text(user_message.text)
+	responses = await run_analysis([user_message.text])
 
-	response = {
-	"is_invalid": is_invalid,
-	"valid_stat": valid_stat
-	}
+	return responses[0]
+
+@app.post("/valid/batch")
+async def analyze_batch(batch: ValidBatchRequest):
+	responses = await run_analysis(batch.texts)
+
+	return {"results": responses}
 
-	return response
+# Административные эндпоинты синхронные: новый набор векторов и пул воркеров
+# собираются в потоке FastAPI, а текущие запросы обслуживаются старой версией
+# до атомарной подмены
+
+def vectors_updated(ok: bool):
+	if not ok:
+		raise HTTPException(status_code=400, detail="Не удалось обновить векторы")
+	version = analysis_pool.refresh()
+	if isinstance(cascade.semantic_stage, EmbeddingStage):
+		# Матрица паттернов строится здесь, а не на первом семантическом запросе;
+		# при ошибке бэкенда запросы сравниваются с прежней, reload повторит попытку
+		try:
+			cascade.semantic_stage.refresh()
+		except Exception as e:
+			raise HTTPException(status_code=502, detail=f"Векторы обновлены, матрица паттернов не перестроена: {e}")
+	return {"status": "ok", "version": version}
+
+@app.get("/admin/vectors", dependencies=[Depends(require_admin)])
+def get_vectors():
+	stats = analysis_pool.classifier.get_vector_stats()
+	stats["serving_version"] = analysis_pool.serving_version
+	return stats
+
+@app.post("/admin/vectors/reload", dependencies=[Depends(require_admin)])
+def reload_vectors():
+	return vectors_updated(analysis_pool.classifier.reload_vectors())
+
+@app.put("/admin/vectors", dependencies=[Depends(require_admin)])
+def replace_vectors(vector_set: VectorSetData):
+	vectors_data = [vector.dict() for vector in vector_set.vectors]
+	return vectors_updated(analysis_pool.classifier.update_vectors_from_data(vectors_data))
+
+@app.put("/admin/vectors/{name}", dependencies=[Depends(require_admin)])
+def put_vector(name: str, vector: VectorData):
+	return vectors_updated(analysis_pool.classifier.add_single_vector(
+		name, vector.description, vector.patterns, vector.weight))
+
+@app.delete("/admin/vectors/{name}", dependencies=[Depends(require_admin)])
+def delete_vector(name: str):
+	if not analysis_pool.classifier.remove_vector(name):
+		raise HTTPException(status_code=404, detail="Вектор не найден")
+	return vectors_updated(True)
+
+def lemma_cache_stats():
+	if PREPROCESS != "lemmatize":
+		return None
+	from service_scripts import prompt_preprocessing
+	return prompt_preprocessing.lemma_cache_stats()
+
+@app.get("/metrics")
+def metrics():
+	return {
+	"vectors_version": analysis_pool.serving_version,
+	"pending": analysis_pool.pending,
+	"verdict_cache": analysis_pool.cache.stats(),
+	"cascade": cascade.metrics.stats(),
+	"lemma_cache": lemma_cache_stats(),
+	"obfuscation": cascade.semantic_stage.stats() if SEMANTIC_STAGE == "obfuscation" else None
+	}
 
 @app.get("/health")
 def health_check():
@@ -0,0 +1,87 @@
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+from edit_distance import WeightedLevenshtein
+
+MIN_WORD_LENGTH = 3
+
+
+def _qgrams(word: str, q: int) -> Counter:
+    return Counter(word[i:i + q] for i in range(len(word) - q + 1))
+
+
+class PatternIndex:
+    """
+    Индекс слов из паттернов векторов угроз: корзины по длине и инвертированный
+    индекс q-грамм. Точное расстояние считается только для кандидатов, которые
+    могут набрать threshold.
+
+    По умолчанию q=1 (совпадение мультимножеств символов): для слов паттернов
+    длиной 3-12 символов биграммный фильтр почти всегда вырождается в ноль.
+    """
+
+    def __init__(self, pattern_words: Iterable[str], edit_distance: WeightedLevenshtein, q: int = 1):
+        self.edit_distance = edit_distance
+        self.q = q
+        self.words: List[str] = sorted({w for w in pattern_words if len(w) >= MIN_WORD_LENGTH})
+
+        self.by_length: Dict[int, List[int]] = defaultdict(list)
+        self.qgrams: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for word_id, word in enumerate(self.words):
+            self.by_length[len(word)].append(word_id)
+            for gram, count in _qgrams(word, q).items():
+                self.qgrams[gram].append((word_id, count))
+
+        # Сколько операций правки укладывается в бюджет расстояния. При нулевой
+        # стоимости какой-либо операции фильтр по q-граммам неприменим.
+        costs = (edit_distance.insertion_cost, edit_distance.deletion_cost, edit_distance.substitution_cost)
+        self._min_edit_cost = min(costs)
+
+    def _length_candidates(self, length: int, threshold: float) -> List[Tuple[int, int]]:
+        """Длины паттернов, совместимые с length, и допустимое расстояние для каждой"""
+        result = []
+        deletion_cost = self.edit_distance.deletion_cost
+        for pattern_length in self.by_length:
+            max_distance = self.edit_distance.max_distance(threshold, max(length, pattern_length))
+            if abs(length - pattern_length) * deletion_cost <= max_distance:
+                result.append((pattern_length, max_distance))
+        return result
+
+    def accepts_length(self, length: int, threshold: float) -> bool:
+        """Может ли строка такой длины набрать threshold хотя бы с одним словом индекса"""
+        return bool(self._length_candidates(length, threshold))
+
+    def lookup(self, word: str, threshold: float) -> List[Tuple[str, float]]:
+        """Слова паттернов со сходством не ниже threshold, в порядке self.words"""
+        if len(word) < MIN_WORD_LENGTH:
+            return []
+
+        q = self.q
+        shared = None
+        candidates = []
+        for pattern_length, max_distance in self._length_candidates(len(word), threshold):
+            word_ids = self.by_length[pattern_length]
+            required = max(len(word), pattern_length) - q + 1
+            if self._min_edit_cost > 0:
+                required -= q * (max_distance // self._min_edit_cost)
+            else:
+                required = 0
+
+            if required <= 0:
+                candidates.extend(word_ids)
+                continue
+
+            if shared is None:
+                shared = Counter()
+                for gram, count in _qgrams(word, q).items():
+                    for word_id, pattern_count in self.qgrams.get(gram, ()):
+                        shared[word_id] += min(count, pattern_count)
+            candidates.extend(word_id for word_id in word_ids if shared[word_id] >= required)
+
+        matches = []
+        for word_id in sorted(candidates):
+            pattern_word = self.words[word_id]
+            similarity = self.edit_distance.similarity(word, pattern_word, threshold)
+            if similarity >= threshold:
+                matches.append((pattern_word, similarity))
+        return matches
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import re
+import threading
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from HeuristicAnalyser import VectorSet
+
+WORD_RE = re.compile(r"\w+")
+
+
+class HashingBackend:
+    """
+    Локальная CPU-модель без скачиваемых весов: хэширование символьных
+    3-грамм и слов в вектор фиксированной размерности. Годится для тестов и
+    как запасной вариант, когда облачный эмбеддер недоступен.
+    """
+
+    def __init__(self, dim: int = 1024, ngram: int = 3):
+        self.dim = dim
+        self.ngram = ngram
+        self.name = f"hashing-{dim}-{ngram}"
+
+    def _features(self, text: str) -> List[int]:
+        features = []
+        for word in WORD_RE.findall(text.lower()):
+            features.append(zlib.crc32(word.encode()) % self.dim)
+            padded = f" {word} "
+            for i in range(len(padded) - self.ngram + 1):
+                features.append(zlib.crc32(padded[i:i + self.ngram].encode()) % self.dim)
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            np.add.at(matrix[row], self._features(text), 1.0)
+        return matrix
+
+
+class SentenceTransformerBackend:
+    """Локальная модель sentence-transformers на CPU, веса берутся из кэша HuggingFace"""
+
+    def __init__(self, model_name: str = "paraphrase-multilingual-MiniLM-L12-v2", batch_size: int = 32):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+        self.name = f"st-{model_name.replace('/', '_')}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, batch_size=self.batch_size), dtype=np.float32)
+
+
+class YandexBackend:
+    """Облачные эмбеддинги через service_scripts/embedder.py, тексты пакета запрашиваются параллельно"""
+
+    name = "yandex-query"
+
+    def __init__(self):
+        from service_scripts.embedder import get_embeddings_textsdk
+
+        self.get_embeddings = get_embeddings_textsdk
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.get_embeddings(texts, text_type="query").astype(np.float32)
+
+
+EMBEDDING_BACKENDS = {
+    "hashing": HashingBackend,
+    "sentence-transformers": SentenceTransformerBackend,
+    "yandex": YandexBackend,
+}
+
+
+def make_backend(name: str):
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {name}")
+    return EMBEDDING_BACKENDS[name]()
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+@dataclass(frozen=True)
+class SemanticResult:
+    vector_scores: Dict[str, float]
+    top_patterns: Dict[str, Tuple[Tuple[str, float], ...]]
+    vectors_version: int
+
+    @property
+    def best_score(self) -> float:
+        return max(self.vector_scores.values(), default=0.0)
+
+
+@dataclass(frozen=True)
+class PatternMatrix:
+    version: int
+    patterns: Tuple[str, ...]
+    # Строки матрицы сгруппированы по векторам угроз: (имя, начало, конец)
+    spans: Tuple[Tuple[str, int, int], ...]
+    matrix: np.ndarray
+
+
+class SemanticMatcher:
+    """
+    Семантическое сравнение сообщений с паттернами векторов угроз.
+
+    Паттерны эмбеддятся один раз в нормированную матрицу (patterns × dim),
+    которая кэшируется на диске по версии набора векторов и его содержимому.
+    Пакет сообщений обрабатывается одним вызовом бэкенда и одним матричным
+    произведением; для каждого вектора угроз берутся top_k лучших паттернов.
+
+    Матрица строится в build() вне пути запроса (при старте и после обновления
+    векторов) и подменяется одной ссылкой, когда готова; match() только читает
+    текущую матрицу и не ждёт перестройки.
+    """
+
+    def __init__(self, backend, cache_dir: Optional[str] = None, top_k: int = 3):
+        self.backend = backend
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self._patterns: Optional[PatternMatrix] = None
+
+    @property
+    def version(self) -> Optional[int]:
+        return self._patterns.version if self._patterns is not None else None
+
+    def _cache_path(self, vector_set: VectorSet, patterns: List[str]) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        # Счётчик версий начинается заново при каждом запуске, поэтому к нему добавлен хэш паттернов
+        digest = hashlib.sha256("\n".join(patterns).encode()).hexdigest()[:16]
+        return self.cache_dir / f"{self.backend.name}-v{vector_set.version}-{digest}.npy"
+
+    def _embed_patterns(self, vector_set: VectorSet, patterns: List[str]) -> np.ndarray:
+        path = self._cache_path(vector_set, patterns)
+        if path is not None and path.exists():
+            matrix = np.load(path)
+            if matrix.shape[0] == len(patterns):
+                return matrix
+
+        matrix = normalize_rows(self.backend.embed(patterns)) if patterns else np.zeros((0, 1), np.float32)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, matrix)
+            os.replace(tmp_path, path)
+        return matrix
+
+    def build(self, vector_set: VectorSet) -> PatternMatrix:
+        """
+        Матрица паттернов для vector_set; повторный вызов с той же версией ничего
+        не делает. Блокировка упорядочивает только построения, match() её не берёт
+        """
+        with self._lock:
+            if self._patterns is not None and self._patterns.version == vector_set.version:
+                return self._patterns
+
+            patterns, spans = [], []
+            for vector in vector_set.threat_vectors:
+                start = len(patterns)
+                patterns.extend(vector.patterns)
+                spans.append((vector.name, start, len(patterns)))
+
+            # Ошибка бэкенда оставляет в работе прежнюю матрицу
+            built = PatternMatrix(
+                version=vector_set.version,
+                patterns=tuple(patterns),
+                spans=tuple(spans),
+                matrix=self._embed_patterns(vector_set, patterns)
+            )
+            self._patterns = built
+            return built
+
+    def match(self, texts: List[str]) -> List[SemanticResult]:
+        """Сравнение с матрицей из последнего завершённого build()"""
+        patterns = self._patterns
+        if patterns is None:
+            raise RuntimeError("Матрица паттернов не построена")
+        if not texts:
+            return []
+        # Все векторы очищены: матрица (0, 1) не перемножается с эмбеддингами
+        if not patterns.patterns:
+            return [SemanticResult({}, {}, patterns.version) for _ in texts]
+
+        embeddings = normalize_rows(self.backend.embed([text.lower() for text in texts]))
+        scores = embeddings @ patterns.matrix.T
+
+        results = []
+        for row in scores:
+            vector_scores, top_patterns = {}, {}
+            for name, start, end in patterns.spans:
+                if start == end:
+                    continue
+                segment = row[start:end]
+                k = min(self.top_k, end - start)
+                best = np.argpartition(-segment, k - 1)[:k]
+                best = best[np.argsort(-segment[best])]
+                top_patterns[name] = tuple((patterns.patterns[start + i], float(segment[i])) for i in best)
+                vector_scores[name] = float(segment[best[0]])
+            results.append(SemanticResult(vector_scores, top_patterns, patterns.version))
+        return results
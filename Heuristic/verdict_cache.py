@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from HeuristicAnalyser import AnalysisResult
+
+
+class VerdictCache:
+    """
+    LRU-кэш результатов PromptInjectionClassifier.analyze.
+
+    Ключ — текст в нижнем регистре (analyze зависит только от него) и версия
+    набора векторов, поэтому после перезагрузки правил старые записи просто
+    перестают находиться и вытесняются. Все операции под одной блокировкой.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, int], AnalysisResult]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.lower()
+
+    def get(self, text: str, version: int) -> Optional[AnalysisResult]:
+        key = (self.normalize(text), version)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, text: str, result: AnalysisResult) -> None:
+        if self.max_size <= 0:
+            return
+        key = (self.normalize(text), result.vectors_version)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,626 @@
+"""
+Микробенчмарки TelegramDatabase.
+
+Запуск из каталога database:
+    python benchmark.py connections
+    python benchmark.py indexes [--messages 1000000]
+    python benchmark.py trim
+    python benchmark.py users
+    python benchmark.py load
+    python benchmark.py ingest
+    python benchmark.py history
+    python benchmark.py budget [--max-tokens 2000]
+    python benchmark.py fts [--messages 150000]
+    python benchmark.py retention [--messages 300000]
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from database import CHARS_PER_TOKEN, MIGRATIONS, TelegramDatabase
+from history_cache import HistoryCache
+from retention import RetentionScheduler
+from storage_executor import StorageExecutor
+from write_behind import WriteBehindBuffer
+
+
+class PerCallDatabase(TelegramDatabase):
+    """Исходное поведение: новое соединение на каждый вызов, журнал отката по умолчанию"""
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_name)
+
+
+class EagerTrimDatabase(TelegramDatabase):
+    """Исходный add_message: DELETE ... NOT IN после каждой вставки"""
+
+    def add_message(self, user_id: int, message_text: str, bot_response: str):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO messages (user_id, message_text, bot_response)
+                VALUES (?, ?, ?)
+            ''', (user_id, message_text, bot_response))
+            cursor.execute('''
+                DELETE FROM messages
+                WHERE user_id = ? AND id NOT IN (
+                    SELECT id FROM messages
+                    WHERE user_id = ?
+                    ORDER BY timestamp DESC
+                    LIMIT 30
+                )
+            ''', (user_id, user_id))
+            conn.commit()
+
+
+class ReplaceUserDatabase(TelegramDatabase):
+    """Исходный add_user: SELECT custom_name и INSERT OR REPLACE на каждый вызов"""
+
+    def add_user(self, user_id: int, username: str = None,
+                 first_name: str = None, last_name: str = None):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT custom_name FROM users WHERE user_id = ?', (user_id,))
+            existing_user = cursor.fetchone()
+            current_custom_name = existing_user[0] if existing_user else None
+            cursor.execute('''
+                INSERT OR REPLACE INTO users
+                (user_id, username, first_name, last_name, custom_name, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (user_id, username, first_name, last_name, current_custom_name))
+            conn.commit()
+
+
+def _rate(func, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - start)
+
+
+def bench_connections(users: int = 50, messages: int = 2000) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cls in [("per-call connect", PerCallDatabase), ("persistent WAL", TelegramDatabase)]:
+            db = cls(str(Path(tmp) / f"{cls.__name__}.db"))
+            mode = db._connect().execute('PRAGMA journal_mode').fetchone()[0]
+            add_message = _rate(lambda i: db.add_message(i % users, f"сообщение {i}", f"ответ {i}"), messages)
+            history = _rate(lambda i: db.get_conversation_history(i % users, 30), messages)
+            add_user = _rate(lambda i: db.add_user(i % users, f"user{i % users}", "Гарри", "Поттер"), messages)
+            print(f"{name:>16} ({mode}): add_message {add_message:8.0f}/s, "
+                  f"get_conversation_history {history:8.0f}/s, add_user {add_user:8.0f}/s")
+            db.close()
+
+
+# Запросы, которые TelegramDatabase выполняет по истории сообщений
+HISTORY_QUERIES = {
+    "get_recent_messages": (
+        "SELECT message_text, bot_response, timestamp FROM messages "
+        "WHERE user_id = ? ORDER BY timestamp DESC LIMIT 30", lambda user: (user,)),
+    "add_message trim": (
+        "SELECT COUNT(*) FROM messages WHERE user_id = ? AND id NOT IN ("
+        "SELECT id FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 30)", lambda user: (user, user)),
+    "get_user_stats": (
+        "SELECT COUNT(*), MIN(timestamp) FROM messages WHERE user_id = ?", lambda user: (user,)),
+    "cleanup_old_messages": (
+        "SELECT COUNT(*) FROM messages WHERE timestamp < datetime('now', ?)", lambda user: ("-3650 days",)),
+}
+
+
+def create_legacy_database(path: str, message_count: int, per_user: int = 30, seed: int = 0) -> int:
+    """База в исходной схеме без индексов и без schema_migrations, как у уже развёрнутых сервисов"""
+    rng = random.Random(seed)
+    users = max(1, message_count // per_user)
+    conn = sqlite3.connect(path)
+    for statement in MIGRATIONS[0][2]:
+        conn.execute(statement)
+    conn.executemany(
+        "INSERT INTO messages (user_id, message_text, bot_response, timestamp) "
+        "VALUES (?, ?, ?, datetime('now', ?))",
+        ((rng.randrange(users), f"сообщение {i}", f"ответ {i}", f"-{rng.randrange(60 * 86400)} seconds")
+         for i in range(message_count)))
+    conn.commit()
+    conn.close()
+    return users
+
+
+def _query_report(conn: sqlite3.Connection, users: int, samples: int = 200) -> None:
+    rng = random.Random(1)
+    for name, (sql, params) in HISTORY_QUERIES.items():
+        plan = "; ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params(0)))
+        count = samples if name != "cleanup_old_messages" else max(1, samples // 40)
+        start = time.perf_counter()
+        for _ in range(count):
+            conn.execute(sql, params(rng.randrange(users))).fetchall()
+        elapsed = (time.perf_counter() - start) / count
+        print(f"  {name:>20}: {elapsed * 1e3:9.3f} ms  [{plan}]")
+
+
+def bench_indexes(message_count: int = 1000000) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "history.db")
+        start = time.perf_counter()
+        users = create_legacy_database(path, message_count)
+        print(f"{message_count} messages, {users} users, generated in {time.perf_counter() - start:.1f} s")
+
+        conn = sqlite3.connect(path)
+        print("schema without indexes:")
+        _query_report(conn, users, samples=20)
+        conn.close()
+
+        start = time.perf_counter()
+        db = TelegramDatabase(path)
+        print(f"in-place upgrade to schema v{db.schema_version()} in {time.perf_counter() - start:.1f} s")
+        print("schema with indexes:")
+        _query_report(db._connect(), users)
+        db.close()
+
+
+def bench_trim(users: int = 200, messages: int = 20000) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cls in [("trim on every insert", EagerTrimDatabase), ("amortized trim", TelegramDatabase)]:
+            db = cls(str(Path(tmp) / f"{cls.__name__}.db"))
+            # Истории уже заполнены до предела, как у работающего сервиса
+            for i in range(users * db.history_retention):
+                db.add_message(i % users, f"сообщение {i}", f"ответ {i}")
+            conn = db._connect()
+            statements = []
+            conn.set_trace_callback(statements.append)
+            rate = _rate(lambda i: db.add_message(i % users, f"сообщение {i}", f"ответ {i}"), messages)
+            conn.set_trace_callback(None)
+            # Каждое срабатывание триггера FTS5 повторяет в трассировке текст вызвавшего его
+            # выражения, между повторами — внутренние запросы FTS5 с префиксом "--"
+            statements = [statement for statement in statements if not statement.lstrip().startswith("--")]
+            deletes = sum(statement.lstrip().startswith("DELETE") and statement != previous
+                          for previous, statement in zip([None] + statements, statements))
+            stored = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            visible = max(len(db.get_recent_messages(user, 100)) for user in range(users))
+            print(f"{name:>21}: add_message {rate:8.0f}/s, DELETE statements per message {deletes / messages:.3f}, "
+                  f"stored {stored / users:.1f} per user, visible {visible}")
+            db.close()
+
+
+def bench_users(users: int = 1000, calls: int = 50000, change_rate: float = 0.01, seed: int = 0) -> None:
+    """add_user на каждое сообщение; change_rate вызовов приходят с изменённым профилем"""
+    rng = random.Random(seed)
+    workload = []
+    profiles = {user: (f"user{user}", "Гарри", "Поттер") for user in range(users)}
+    for i in range(calls):
+        user = rng.randrange(users)
+        if rng.random() < change_rate:
+            profiles[user] = (f"user{user}_{i}",) + profiles[user][1:]
+        workload.append((user,) + profiles[user])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cls in [("select + replace", ReplaceUserDatabase), ("upsert + profile cache", TelegramDatabase)]:
+            db = cls(str(Path(tmp) / f"{cls.__name__}.db"))
+            conn = db._connect()
+            # Без автоматических контрольных точек весь объём записи остаётся в WAL
+            conn.execute("PRAGMA wal_autocheckpoint = 0")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            changes = conn.total_changes
+            rate = _rate(lambda i: db.add_user(*workload[i]), calls)
+            rows = conn.total_changes - changes
+            wal_pages = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()[1]
+            print(f"{name:>22}: add_user {rate:9.0f}/s, rows written {rows:6d}, WAL pages {wal_pages:6d} "
+                  f"({wal_pages / calls:.3f} per call)")
+            if cls is TelegramDatabase:
+                print(f"{'':>22}  {db.profile_stats()}")
+            db.close()
+
+
+class BlockingStorage:
+    """Исходные эндпоинты: вызов sqlite3 прямо в event loop"""
+
+    async def read(self, func, *args):
+        return func(*args)
+
+    async def write(self, func, *args):
+        return func(*args)
+
+    def shutdown(self) -> None:
+        pass
+
+
+async def _read_latencies(storage, db: TelegramDatabase, users: int, duration: float, interval: float,
+                          writers: int, heavy_cleanup: bool):
+    """Чтения истории приходят каждые interval секунд; задержка считается от момента прихода"""
+    rng = random.Random(0)
+    latencies = []
+    stop = time.perf_counter() + duration
+
+    async def reader(arrived: float, user: int):
+        await storage.read(db.get_conversation_history, user, 30)
+        latencies.append(time.perf_counter() - arrived)
+
+    async def writer(worker: int):
+        i = 0
+        while time.perf_counter() < stop:
+            await storage.write(db.add_message, (worker * 7919 + i) % users, f"сообщение {i}", f"ответ {i}")
+            i += 1
+            await asyncio.sleep(0)
+
+    async def cleanup():
+        # Очистка по времени, удаляющая большую часть таблицы одной транзакцией
+        await asyncio.sleep(duration / 4)
+        await storage.write(db.cleanup_old_messages, 1)
+
+    background = [asyncio.ensure_future(writer(w)) for w in range(writers)]
+    if heavy_cleanup:
+        background.append(asyncio.ensure_future(cleanup()))
+    requests = []
+    next_arrival = time.perf_counter()
+    while next_arrival < stop:
+        await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+        requests.append(asyncio.ensure_future(reader(next_arrival, rng.randrange(users))))
+        next_arrival += interval
+    await asyncio.gather(*requests, *background)
+    return latencies
+
+
+def _fill_history(path: str, users: int, per_user: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO messages (user_id, message_text, bot_response, timestamp) VALUES (?, ?, ?, datetime('now', ?))",
+        ((i % users, f"сообщение {i}", f"ответ {i}", f"-{2 + i % 5} days") for i in range(users * per_user)))
+    conn.commit()
+    conn.close()
+
+
+def bench_load(users: int = 10000, duration: float = 3.0, interval: float = 0.002) -> None:
+    scenarios = [("idle", 0, False), ("heavy writes", 4, False), ("writes + big cleanup", 4, True)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make_storage in [("blocking event loop", BlockingStorage), ("storage executor", StorageExecutor)]:
+            for scenario, writers, heavy_cleanup in scenarios:
+                path = str(Path(tmp) / f"{make_storage.__name__}-{writers}-{heavy_cleanup}.db")
+                TelegramDatabase(path).close()
+                _fill_history(path, users, 20)
+                db = TelegramDatabase(path)
+                storage = make_storage()
+                try:
+                    latencies = asyncio.run(_read_latencies(storage, db, users, duration, interval,
+                                                            writers, heavy_cleanup))
+                finally:
+                    storage.shutdown()
+                    db.close()
+                latencies.sort()
+                p50 = latencies[len(latencies) // 2] * 1e3
+                p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+                print(f"{name:>19}, {scenario:>20}: {len(latencies)} reads, "
+                      f"p50 {p50:8.2f} ms, p99 {p99:8.2f} ms, max {latencies[-1] * 1e3:8.2f} ms")
+
+
+async def _ingest(storage: StorageExecutor, add, users: int, messages: int, clients: int) -> None:
+    async def client(worker: int):
+        for i in range(worker, messages, clients):
+            await add(i % users, f"сообщение {i}", f"ответ {i}")
+
+    await asyncio.gather(*[client(w) for w in range(clients)])
+
+
+def bench_ingest(users: int = 1000, messages: int = 5000, clients: int = 16) -> None:
+    """Сколько add_message в секунду принимает сервис при clients одновременных запросах"""
+    modes = [
+        ("direct, synchronous=NORMAL", dict(synchronous="NORMAL"), None),
+        ("direct, synchronous=FULL", dict(synchronous="FULL"), None),
+        ("write-behind, fsync each", {}, 0),
+        ("write-behind, fsync 20 ms", {}, 20),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, options, fsync_ms in modes:
+            path = str(Path(tmp) / f"{len(name)}-{fsync_ms}.db")
+            db = TelegramDatabase(path, **options)
+            storage = StorageExecutor()
+            buffer = None
+            if fsync_ms is None:
+                async def add(*args):
+                    await storage.write(db.add_message, *args)
+            else:
+                buffer = WriteBehindBuffer(db, path + ".log", fsync_interval_ms=fsync_ms, writer=storage.writer)
+                buffer.start()
+
+                async def add(*args):
+                    await storage.append(buffer.append, *args)
+
+            start = time.perf_counter()
+            asyncio.run(_ingest(storage, add, users, messages, clients))
+            elapsed = time.perf_counter() - start
+            line = f"{name:>27}: {messages / elapsed:8.0f} msg/s"
+            if buffer is not None:
+                stats = buffer.stats()
+                buffer.shutdown()
+                line += (f", fsyncs {stats['fsyncs'] / elapsed:7.0f}/s, flushes {stats['flushes']}, "
+                         f"{stats['avg_flush_rows']:.0f} rows per transaction")
+            else:
+                line += f", {storage.stats()['write']['calls']} transactions"
+            stored = db._connect().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            print(line + f", stored {stored}")
+            storage.shutdown()
+            db.close()
+
+
+def bench_history(users: int = 5000, turns: int = 20000, cache_mb: int = 8, seed: int = 0) -> None:
+    """Как в orchestrator: на каждое сообщение два чтения истории и одна запись"""
+    rng = random.Random(seed)
+    # Активность пользователей неравномерна: небольшая часть пишет большую часть сообщений
+    weights = [1 / (rank + 1) for rank in range(users)]
+    active = rng.choices(range(users), weights=weights, k=turns)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "history.db")
+        TelegramDatabase(path).close()
+        _fill_history(path, users, 30)
+        for name, cache in [("sqlite only", None), (f"ring buffer {cache_mb} MB", HistoryCache(cache_mb * 1024 * 1024))]:
+            db = TelegramDatabase(path)
+            if cache is None:
+                get_history = db.get_conversation_history
+            else:
+                def get_history(user_id, limit):
+                    return cache.get_history(user_id, limit, db.get_recent_messages)
+            read_seconds = 0.0
+            start = time.perf_counter()
+            for i, user in enumerate(active):
+                for _ in range(2):
+                    read_start = time.perf_counter()
+                    get_history(user, 50)
+                    read_seconds += time.perf_counter() - read_start
+                db.add_message(user, f"вопрос {i}", f"ответ {i}")
+                if cache is not None:
+                    cache.append(user, f"вопрос {i}", f"ответ {i}")
+            elapsed = time.perf_counter() - start
+            line = (f"{name:>18}: {turns / elapsed:8.0f} turns/s, "
+                    f"get_history {read_seconds / (2 * turns) * 1e6:7.1f} us")
+            if cache is not None:
+                stats = cache.stats()
+                line += (f", hit rate {stats['hit_rate']:.3f}, memo hits {stats['memo_hits']}, "
+                         f"{stats['users']} users in {stats['bytes'] / 2 ** 20:.1f} MB, evictions {stats['evictions']}")
+            print(line)
+            db.close()
+
+
+CORPUS_PATH = Path(__file__).resolve().parent.parent / "Heuristic" / "corpus" / "v1.jsonl"
+
+
+def _percentile(values, share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def bench_budget(max_tokens: int = 2000, users: int = 300, turns: int = 6000, seed: int = 0) -> None:
+    """
+    Размер истории в промпте агента: limit=50 против бюджета max_tokens.
+
+    Вопросы — тексты из корпуса Heuristic, длины ответов бота — логнормальные
+    (медиана 600 символов, длинный хвост до maxTokens=2000 ответа YandexGPT).
+    """
+    rng = random.Random(seed)
+    questions = [json.loads(line)["text"] for line in CORPUS_PATH.read_text(encoding="utf-8").splitlines()]
+    filler = " ".join(questions)
+    weights = [1 / (rank + 1) for rank in range(users)]
+    active = rng.choices(range(users), weights=weights, k=turns)
+
+    modes = [
+        ("limit=50", {}),
+        (f"{max_tokens} tokens", {"max_tokens": max_tokens}),
+        (f"{max_tokens} tokens, truncate", {"max_tokens": max_tokens, "truncate": True}),
+        (f"{max_tokens // 2} tokens, truncate", {"max_tokens": max_tokens // 2, "truncate": True}),
+    ]
+    sizes = {name: [] for name, _ in modes}
+    kept = {name: [] for name, _ in modes}
+    truncated = {name: 0 for name, _ in modes}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = TelegramDatabase(str(Path(tmp) / "budget.db"))
+        for user in active:
+            messages = db.get_recent_messages(user, 50)
+            for name, options in modes:
+                window = db.budget_history(messages, **options)
+                sizes[name].append(window["tokens"])
+                kept[name].append(window["turns"])
+                truncated[name] += window["truncated"]
+            length = min(int(rng.lognormvariate(6.4, 0.8)), 2000 * CHARS_PER_TOKEN)
+            start = rng.randrange(len(filler))
+            db.add_message(user, rng.choice(questions), (filler[start:] + filler)[:length])
+        db.close()
+
+    baseline = sum(sizes[modes[0][0]])
+    print(f"{turns} requests, {users} users, tokens of history per request ({CHARS_PER_TOKEN} chars/token)")
+    for name, _ in modes:
+        values = sizes[name]
+        print(f"{name:>24}: mean {sum(values) / len(values):7.0f}, p95 {_percentile(values, 0.95):6d}, "
+              f"max {max(values):6d}, turns {sum(kept[name]) / len(kept[name]):5.1f}, "
+              f"truncated {truncated[name]:5d}, total {sum(values) / baseline:6.1%}")
+
+
+# Вопросы со знаками внутри слов: FTS5 делит их на отдельные слова, а запрос
+# из такого "слова" стал бы фразой, которую detail='column' не принимает
+FTS_PUNCTUATION_QUERIES = [
+    ("как задать my_var в bash?", "my_var"),
+    ("что такое __init__ в python", "__init__"),
+    ("какой компилятор C++ или C#?", "компилятор C++"),
+    ("it's a-b test: x.y_z", "a-b test"),
+    ("адрес user@example.com не работает", "example.com"),
+    ("ответ_на_вопрос_про_ёлку", "ёлку"),
+]
+
+
+def check_fts_punctuation() -> None:
+    """
+    Поиск по истории с индексом FTS5 и без него не падает на вопросах со знаками
+    внутри слов и находит ход по ним
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for fts in (True, False):
+            db = TelegramDatabase(str(Path(tmp) / f"punctuation-{fts}.db"), fts_index=fts)
+            try:
+                for question, word in FTS_PUNCTUATION_QUERIES:
+                    db.add_message(1, f"старый вопрос про {word}", "старый ответ")
+                for i in range(4):
+                    db.add_message(1, f"последнее сообщение {i}", "ответ")
+                turns = db.get_recent_messages(1, db.history_retention)[:-4]
+                for question, word in FTS_PUNCTUATION_QUERIES:
+                    if fts:
+                        found = db.get_relevant_messages(1, question, k=len(FTS_PUNCTUATION_QUERIES), skip_recent=4)
+                    else:
+                        found = db.rank_relevant(turns, question, k=len(FTS_PUNCTUATION_QUERIES))
+                    assert any(word in turn["user_message"] for turn in found), (fts, question, found)
+            finally:
+                db.close()
+    print(f"fts punctuation check: {len(FTS_PUNCTUATION_QUERIES)} queries ok, with and without index")
+
+
+def bench_fts(message_count: int = 150000, per_user: int = 30, queries: int = 2000, single_writes: int = 5000,
+              seed: int = 0) -> None:
+    """
+    Поиск релевантных ходов с индексом FTS5 и без него (rank_relevant по истории
+    пользователя, уже прочитанной в память, как в HistoryCache): пакетная вставка
+    и add_message по одному сообщению, задержка запроса, размер файла
+    """
+    check_fts_punctuation()
+    rng = random.Random(seed)
+    questions = [json.loads(line)["text"] for line in CORPUS_PATH.read_text(encoding="utf-8").splitlines()]
+    filler = " ".join(questions)
+    users = max(1, message_count // per_user)
+
+    def rows(count):
+        for i in range(count):
+            start = rng.randrange(len(filler))
+            yield i % users, rng.choice(questions), (filler[start:] + filler)[:rng.randrange(100, 600)], None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fts in [("in memory", False), ("fts5 triggers", True)]:
+            path = str(Path(tmp) / f"{name}.db")
+            db = TelegramDatabase(path, history_retention=per_user, fts_index=fts)
+            batch = list(rows(message_count))
+            start = time.perf_counter()
+            for offset in range(0, len(batch), 1000):
+                db.add_messages([(u, q, a, "2025-01-01 00:00:00") for u, q, a, _ in batch[offset:offset + 1000]])
+            elapsed = time.perf_counter() - start
+            single = batch[:single_writes]
+            single_start = time.perf_counter()
+            for user, question, answer, _ in single:
+                db.add_message(user, question, answer)
+            single_elapsed = time.perf_counter() - single_start
+            db._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            size = Path(path).stat().st_size
+            line = (f"{name:>14}: insert {message_count / elapsed:8.0f} msg/s, add_message "
+                    f"{len(single) / single_elapsed:7.0f} msg/s, file {size / 2 ** 20:6.1f} MB")
+            latencies = []
+            found = 0
+            for _ in range(queries):
+                user = rng.randrange(users)
+                question = rng.choice(questions)
+                if fts:
+                    query_start = time.perf_counter()
+                    found += len(db.get_relevant_messages(user, question, k=3, skip_recent=4))
+                else:
+                    turns = db.get_recent_messages(user, per_user)[:-4]
+                    query_start = time.perf_counter()
+                    found += len(db.rank_relevant(turns, question, k=3))
+                latencies.append(time.perf_counter() - query_start)
+            line += (f", search p50 {_percentile(latencies, 0.5) * 1e3:.2f} ms, "
+                     f"p99 {_percentile(latencies, 0.99) * 1e3:.2f} ms, {found / queries:.1f} turns found")
+            print(line)
+            db.close()
+
+
+def delete_expired_at_once(db: TelegramDatabase, days: int) -> int:
+    """Исходный cleanup_old_messages: одна транзакция на все устаревшие сообщения"""
+    with db._connect() as conn:
+        return conn.execute("DELETE FROM messages WHERE timestamp < datetime('now', ?)", (f'-{days} days',)).rowcount
+
+
+async def _writes_during_purge(db: TelegramDatabase, storage: StorageExecutor, purge, users: int, writers: int):
+    """Задержки add_message через очередь писателя, пока идёт очистка"""
+    latencies = []
+    done = asyncio.Event()
+
+    async def writer(worker: int):
+        i = 0
+        while not done.is_set():
+            start = time.perf_counter()
+            await storage.write(db.add_message, (worker * 7919 + i) % users, f"сообщение {i}", f"ответ {i}")
+            latencies.append(time.perf_counter() - start)
+            i += 1
+            await asyncio.sleep(0.001)
+
+    tasks = [asyncio.ensure_future(writer(w)) for w in range(writers)]
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    deleted = await purge()
+    elapsed = time.perf_counter() - start
+    done.set()
+    await asyncio.gather(*tasks)
+    return deleted, elapsed, latencies
+
+
+def bench_retention(expired: int = 300000, users: int = 10000, writers: int = 4) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ["one transaction", "batched scheduler"]:
+            path = str(Path(tmp) / f"{name}.db")
+            db = TelegramDatabase(path)
+            conn = db._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO messages (user_id, message_text, bot_response, timestamp) "
+                    "VALUES (?, ?, ?, datetime('now', '-40 days'))",
+                    ((i % users, f"старое сообщение {i}", f"старый ответ {i}") for i in range(expired)))
+            storage = StorageExecutor()
+            scheduler = RetentionScheduler(db, storage, days=30)
+
+            async def purge():
+                if name == "one transaction":
+                    return await storage.write(delete_expired_at_once, db, 30)
+                return await scheduler.purge_expired()
+
+            try:
+                deleted, elapsed, latencies = asyncio.run(_writes_during_purge(db, storage, purge, users, writers))
+                file_stats = db.storage_stats()
+            finally:
+                storage.shutdown()
+                db.close()
+            latencies.sort()
+            line = (f"{name:>17}: deleted {deleted} in {elapsed:5.2f} s, {len(latencies)} add_message, "
+                    f"p50 {_percentile(latencies, 0.5) * 1e3:7.2f} ms, p99 {_percentile(latencies, 0.99) * 1e3:7.2f} ms, "
+                    f"max {latencies[-1] * 1e3:7.2f} ms, free pages {file_stats['freelist_count']}")
+            if name != "one transaction":
+                stats = scheduler.stats()
+                line += f", {stats['batches']} batches, max batch {stats['max_batch_ms']:.1f} ms"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bench", choices=["connections", "indexes", "trim", "users", "load", "ingest", "history",
+                                          "budget", "fts", "retention"])
+    parser.add_argument("--messages", type=int,
+                        help="размер базы для indexes (1000000) и fts (150000), устаревших сообщений для retention (300000)")
+    parser.add_argument("--max-tokens", type=int, default=2000, help="бюджет истории для budget")
+    args = parser.parse_args()
+
+    if args.bench == "connections":
+        bench_connections()
+    elif args.bench == "indexes":
+        bench_indexes(args.messages or 1000000)
+    elif args.bench == "trim":
+        bench_trim()
+    elif args.bench == "users":
+        bench_users()
+    elif args.bench == "load":
+        bench_load()
+    elif args.bench == "ingest":
+        bench_ingest()
+    elif args.bench == "history":
+        bench_history()
+    elif args.bench == "budget":
+        bench_budget(args.max_tokens)
+    elif args.bench == "fts":
+        bench_fts(args.messages or 150000)
+    elif args.bench == "retention":
+        bench_retention(args.messages or 300000)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,350 @@
 import sqlite3
 import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+# Сколько последних сообщений пользователя видно в истории
+HISTORY_RETENTION = 30
+
+# Оценка длины в токенах для бюджета истории: в токенизаторе YandexGPT на русский
+# текст выходит 3-4 символа на токен, берём с запасом
+CHARS_PER_TOKEN = 3
+# Меньше этого ход при обрезке по бюджету не сокращается, а отбрасывается
+MIN_TRUNCATED_TURN_CHARS = 80
+# "User: " + "\n" + "Bot: "
+TURN_FORMAT_CHARS = 12
+
+# Поиск по истории: не больше FTS_MAX_TERMS слов вопроса в запросе FTS5, слова
+# короче FTS_MIN_WORD_CHARS и служебные слова пропускаются. Длина префикса
+# совпадает с prefix='5' в миграции messages_fts
+FTS_MAX_TERMS = 16
+FTS_MIN_WORD_CHARS = 3
+FTS_PREFIX_CHARS = 5
+# Слова так, как их делит токенизатор unicode61: буквы и цифры, "_" и прочие
+# знаки — разделители. Иначе "my_var" стал бы фразой из двух слов, а фразы
+# при detail='column' FTS5 не поддерживает
+FTS_WORD_RE = re.compile(r"[^\W_]+")
+FTS_STOP_WORDS = {
+    'что', 'как', 'это', 'его', 'она', 'они', 'оно', 'так', 'вот', 'был', 'была', 'были', 'быть',
+    'уже', 'ещё', 'еще', 'или', 'для', 'при', 'над', 'под', 'без', 'тебя', 'тебе', 'меня', 'мне',
+    'где', 'кто', 'чем', 'там', 'тут', 'если', 'когда', 'только', 'тоже', 'нет', 'про', 'расскажи',
+    'the', 'and', 'you', 'are', 'was', 'what', 'who', 'how', 'this', 'that', 'with', 'for',
+    'your', 'have', 'has', 'not', 'but', 'can', 'about', 'from', 'tell',
+}
+
+# Сообщений в одной транзакции очистки: столько держится блокировка записи
+DELETE_BATCH_ROWS = 250
+
+# Строк в одном INSERT пакетной вставки: 4 параметра на строку, не больше 999 параметров
+INSERT_CHUNK_ROWS = 240
+
+# Триггеры, поддерживающие messages_fts. Создаются миграцией 4; без fts_index
+# TelegramDatabase удаляет их, и запись сообщений не платит за индекс
+FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, user_id, message_text, bot_response)
+        VALUES (new.id, new.user_id, new.message_text, new.bot_response);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, user_id, message_text, bot_response)
+        VALUES ('delete', old.id, old.user_id, old.message_text, old.bot_response);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, user_id, message_text, bot_response)
+        VALUES ('delete', old.id, old.user_id, old.message_text, old.bot_response);
+        INSERT INTO messages_fts (rowid, user_id, message_text, bot_response)
+        VALUES (new.id, new.user_id, new.message_text, new.bot_response);
+    END
+    ''',
+]
+
+# Миграции схемы: (версия, название, SQL). Существующие базы без таблицы
+# schema_migrations обновляются на месте: первая миграция повторяет исходную
+# схему через IF NOT EXISTS. Новые миграции только добавляются в конец.
+MIGRATIONS = [
+    (1, 'initial', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            custom_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_text TEXT,
+            bot_response TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+    ]),
+    # История пользователя, обрезка в add_message и статистика читают только
+    # индекс (id входит в него как rowid); очистка по времени — диапазон по второму
+    (2, 'messages_indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)',
+    ]),
+    # Последний номер записи журнала write-behind, уже перенесённой в messages
+    (3, 'write_behind_state', [
+        '''
+        CREATE TABLE IF NOT EXISTS write_behind_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_seq INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    # Полнотекстовый индекс по сообщениям. Текст хранится только в messages
+    # (external content), индекс поддерживают триггеры; user_id проиндексирован,
+    # чтобы поиск сразу сужался до одного пользователя, префиксный индекс на
+    # 5 букв — для поиска по основам слов (FTS_PREFIX_CHARS). Позиции слов не
+    # хранятся (detail='column'): поиск фраз не нужен, а индекс меньше
+    (4, 'messages_fts', [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            user_id, message_text, bot_response,
+            content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='5', detail='column'
+        )
+        ''',
+        # Слияние сегментов реже и большими порциями: меньше работы на каждую вставку
+        "INSERT INTO messages_fts (messages_fts, rank) VALUES ('automerge', 8)",
+        *FTS_TRIGGERS,
+        # Сообщения, накопленные до миграции
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ]),
+]
+
+
+class ConnectionManager:
+    """
+    Постоянные соединения SQLite, по одному на поток: соединение открывается
+    при первом обращении из потока и живёт до close(). Каждое соединение
+    хранит кэш подготовленных выражений, поэтому повторные запросы не
+    компилируются заново.
+
+    База переводится в режим WAL: читатели не блокируют писателя и наоборот,
+    а synchronous=NORMAL в WAL не теряет целостность при сбое процесса
+    (последние транзакции могут потеряться только при отключении питания).
+    """
+
+    def __init__(self, db_name: str, synchronous: str = "NORMAL", cache_size_kib: int = 16384,
+                 busy_timeout_ms: int = 5000, cached_statements: int = 256):
+        self.db_name = db_name
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def _open(self) -> sqlite3.Connection:
+        # check_same_thread=False только ради close() из другого потока,
+        # запросы к соединению идут из потока-владельца
+        conn = sqlite3.connect(self.db_name, timeout=self.busy_timeout_ms / 1000,
+                               cached_statements=self.cached_statements, check_same_thread=False)
+        # Новая база создаётся с auto_vacuum=INCREMENTAL (до перехода в WAL, пока файл
+        # пуст); на существующей режим меняется только после VACUUM
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = -{self.cache_size_kib}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute(f'PRAGMA busy_timeout = {self.busy_timeout_ms}')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока; как контекстный менеджер делает commit или rollback"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
 
 
 class TelegramDatabase:
-    def __init__(self, db_name: str = "telegram_bot.db"):
+    def __init__(self, db_name: str = "telegram_bot.db", history_retention: int = HISTORY_RETENTION,
+                 trim_factor: int = 2, profile_cache_size: int = 100000, fts_index: bool = False,
+                 **connection_options):
         self.db_name = db_name
+        self.history_retention = history_retention
+        # Индекс messages_fts для get_relevant_messages; без него каждая запись сообщения
+        # втрое дешевле, а ходы по вопросу ищет rank_relevant в уже прочитанной истории
+        self.fts_index = fts_index
+        # Обрезка истории пользователя, когда в ней больше trim_factor × history_retention сообщений
+        self.trim_threshold = max(history_retention, history_retention * trim_factor)
+        self._message_counts: Dict[int, int] = {}
+        self._counts_lock = threading.Lock()
+        # Профили (username, first_name, last_name), уже записанные в базу: повторный
+        # add_user с теми же полями не идёт в SQLite. Хранятся сами поля, а не хэш:
+        # при совпадении хэшей разных профилей запись потерялась бы
+        self.profile_cache_size = profile_cache_size
+        self._profiles: "OrderedDict[int, Tuple[Optional[str], Optional[str], Optional[str]]]" = OrderedDict()
+        self._profiles_lock = threading.Lock()
+        self._profile_stats = {"calls": 0, "cache_hits": 0, "writes": 0, "unchanged": 0}
+        self.connections = ConnectionManager(db_name, **connection_options)
         self.init_database()
 
-    def init_database(self):
-        """Инициализация базы данных с объединенной таблицей"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+    def _connect(self) -> sqlite3.Connection:
+        return self.connections.connection()
 
-            # ЕДИНАЯ таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    custom_name TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+    def close(self):
+        """Закрытие всех открытых соединений"""
+        self.connections.close()
 
-            # Таблица сообщений
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    message_text TEXT,
-                    bot_response TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+    def init_database(self):
+        """Инициализация базы данных: таблица версий схемы и недостающие миграции"""
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-
+        self.migrate()
+        self._configure_fts()
+
+    def schema_version(self) -> int:
+        row = self._connect().execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+        return row[0] or 0
+
+    def migrate(self) -> List[int]:
+        """
+        Применяет миграции новее текущей версии схемы, каждую в отдельной
+        транзакции. BEGIN IMMEDIATE сразу берёт блокировку записи, так что
+        несколько процессов, стартующих одновременно, не применят одну
+        миграцию дважды. Возвращает номера применённых миграций.
+        """
+        conn = self._connect()
+        applied = []
+        for version, name, statements in MIGRATIONS:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,)).fetchone():
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+        return applied
+
+    def _configure_fts(self) -> None:
+        """
+        Триггеры messages_fts по настройке fts_index. При включении индекс
+        перестраивается по текущим сообщениям, при выключении очищается
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            triggers = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'messages_fts_%'")]
+            if self.fts_index and len(triggers) < len(FTS_TRIGGERS):
+                for statement in FTS_TRIGGERS:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            elif not self.fts_index and triggers:
+                for name in triggers:
+                    conn.execute(f'DROP TRIGGER {name}')
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _profile_known(self, user_id: int, profile: Tuple) -> bool:
+        with self._profiles_lock:
+            self._profile_stats["calls"] += 1
+            if self._profiles.get(user_id) == profile:
+                self._profiles.move_to_end(user_id)
+                self._profile_stats["cache_hits"] += 1
+                return True
+            return False
+
+    def _remember_profile(self, user_id: int, profile: Tuple, written: bool):
+        with self._profiles_lock:
+            self._profile_stats["writes" if written else "unchanged"] += 1
+            if self.profile_cache_size <= 0:
+                return
+            self._profiles[user_id] = profile
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > self.profile_cache_size:
+                self._profiles.popitem(last=False)
 
     def add_user(self, user_id: int, username: str = None,
-                 first_name: str = None, last_name: str = None):
-        """Добавление/обновление пользователя БЕЗ потери custom_name"""
-        with sqlite3.connect(self.db_name) as conn:
+                 first_name: str = None, last_name: str = None) -> bool:
+        """
+        Добавление/обновление пользователя БЕЗ потери custom_name и created_at.
+        Строка пишется, только если поля профиля Telegram изменились; профили,
+        уже известные процессу, проверяются без обращения к базе. Возвращает
+        True, если база изменилась.
+        """
+        profile = (username, first_name, last_name)
+        if self._profile_known(user_id, profile):
+            return False
+
+        with self._connect() as conn:
             cursor = conn.cursor()
-
-            # Сначала проверяем, есть ли пользователь и его custom_name
-            cursor.execute('SELECT custom_name FROM users WHERE user_id = ?', (user_id,))
-            existing_user = cursor.fetchone()
-            current_custom_name = existing_user[0] if existing_user else None
-
             cursor.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, username, first_name, last_name, custom_name, updated_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, username, first_name, last_name, current_custom_name))
+                INSERT INTO users (user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE username IS NOT excluded.username
+                    OR first_name IS NOT excluded.first_name
+                    OR last_name IS NOT excluded.last_name
+            ''', (user_id, username, first_name, last_name))
+            written = cursor.rowcount > 0
             conn.commit()
 
+        self._remember_profile(user_id, profile, written)
+        return written
+
+    def profile_stats(self) -> Dict:
+        """Сколько вызовов add_user обошлись без базы и сколько реально записали строку"""
+        with self._profiles_lock:
+            stats = dict(self._profile_stats)
+            stats["cache_size"] = len(self._profiles)
+        stats["cache_hit_rate"] = stats["cache_hits"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
     def update_user_name(self, user_id: int, name: str):
         """Обновление кастомного имени пользователя"""
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE users 
@@ -72,7 +355,7 @@ class TelegramDatabase:
 
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получение полной информации о пользователе"""
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT user_id, username, first_name, last_name, custom_name, created_at
@@ -100,39 +383,225 @@ class TelegramDatabase:
             return user.get('custom_name') or user.get('first_name') or user.get('username')
         return None
 
+    def _trim_user(self, cursor: sqlite3.Cursor, user_id: int, keep_count: int) -> int:
+        """Удаляет сообщения пользователя старше keep_count последних одним диапазоном по id"""
+        cursor.execute('''
+            SELECT id FROM messages
+            WHERE user_id = ?
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1 OFFSET ?
+        ''', (user_id, keep_count - 1))
+
+        result = cursor.fetchone()
+        if not result:
+            return 0
+        cursor.execute('''
+            DELETE FROM messages
+            WHERE user_id = ? AND id < ?
+        ''', (user_id, result[0]))
+        return cursor.rowcount
+
+    def _count_added(self, cursor: sqlite3.Cursor, user_id: int, added: int = 1) -> int:
+        """Число сообщений пользователя после вставки; из базы читается только при первом обращении"""
+        with self._counts_lock:
+            count = self._message_counts.get(user_id)
+            if count is not None:
+                self._message_counts[user_id] = count + added
+                return count + added
+        cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
+        count = cursor.fetchone()[0]
+        with self._counts_lock:
+            self._message_counts[user_id] = count
+        return count
+
+    def _forget_count(self, user_id: int):
+        with self._counts_lock:
+            self._message_counts.pop(user_id, None)
+
     def add_message(self, user_id: int, message_text: str, bot_response: str):
-        """Добавление сообщения в историю с автоматической очисткой старых"""
-        with sqlite3.connect(self.db_name) as conn:
+        """
+        Добавление сообщения в историю. Старые сообщения удаляются не при
+        каждой вставке, а когда у пользователя их накопилось больше
+        trim_threshold; читатели всё равно видят только history_retention
+        последних.
+        """
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO messages (user_id, message_text, bot_response)
                 VALUES (?, ?, ?)
             ''', (user_id, message_text, bot_response))
 
-            # Очищаем старые сообщения после добавления нового
-            cursor.execute('''
-                DELETE FROM messages 
-                WHERE user_id = ? AND id NOT IN (
-                    SELECT id FROM messages 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT 30
-                )
-            ''', (user_id, user_id))
+            if self._count_added(cursor, user_id) > self.trim_threshold:
+                self._trim_user(cursor, user_id, self.history_retention)
+                # Пересчитаем при следующей вставке: счётчик мог разойтись с базой после очистки по времени
+                self._forget_count(user_id)
+
+            conn.commit()
 
+    def add_messages(self, rows: List[Tuple[int, str, str, str]], log_seq: Optional[int] = None):
+        """
+        Пакетная вставка (user_id, message_text, bot_response, timestamp) одной
+        транзакцией. log_seq — номер последней записи журнала write-behind в
+        пакете, он сохраняется в той же транзакции; такая транзакция
+        фиксируется с synchronous=FULL, потому что после неё журнал очищается.
+        """
+        conn = self._connect()
+        if log_seq is not None:
+            conn.execute('PRAGMA synchronous = FULL')
+        try:
+            self._insert_messages(conn, rows, log_seq)
+        finally:
+            if log_seq is not None:
+                conn.execute(f'PRAGMA synchronous = {self.connections.synchronous}')
+
+    def _insert_messages(self, conn: sqlite3.Connection, rows: List[Tuple[int, str, str, str]],
+                         log_seq: Optional[int]):
+        with conn:
+            cursor = conn.cursor()
+            # Многострочный VALUES вместо executemany: на каждую строку executemany
+            # отпускает и снова берёт GIL, и под нагрузкой пакет ждёт event loop
+            for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+                chunk = rows[start:start + INSERT_CHUNK_ROWS]
+                cursor.execute(
+                    'INSERT INTO messages (user_id, message_text, bot_response, timestamp) VALUES '
+                    + ', '.join(['(?, ?, ?, ?)'] * len(chunk)),
+                    [value for row in chunk for value in row])
+
+            added: Dict[int, int] = {}
+            for row in rows:
+                added[row[0]] = added.get(row[0], 0) + 1
+            for user_id, count in added.items():
+                total = self._count_added(cursor, user_id, count)
+                if total > self.trim_threshold:
+                    self._trim_user(cursor, user_id, self.history_retention)
+                    self._forget_count(user_id)
+
+            if log_seq is not None:
+                cursor.execute('''
+                    INSERT INTO write_behind_state (id, last_seq) VALUES (1, ?)
+                    ON CONFLICT (id) DO UPDATE SET last_seq = excluded.last_seq
+                ''', (log_seq,))
+            conn.commit()
+
+    def write_behind_seq(self) -> int:
+        row = self._connect().execute('SELECT last_seq FROM write_behind_state WHERE id = 1').fetchone()
+        return row[0] if row else 0
+
+    def compact_history(self, batch_size: int = 100) -> int:
+        """
+        Обрезает до history_retention историю всех пользователей, у которых
+        сообщений больше; по batch_size пользователей в транзакции, чтобы не
+        держать блокировку записи долго. Возвращает число удалённых сообщений.
+        """
+        user_ids = self.users_over_retention()
+        deleted = 0
+        for start in range(0, len(user_ids), batch_size):
+            deleted += self.trim_users(user_ids[start:start + batch_size])["deleted"]
+        return deleted
+
+    def users_over_retention(self) -> List[int]:
+        """Пользователи, у которых сообщений больше history_retention"""
+        return [row[0] for row in self._connect().execute('''
+            SELECT user_id FROM messages
+            GROUP BY user_id
+            HAVING COUNT(*) > ?
+        ''', (self.history_retention,))]
+
+    def _begin_write(self, conn: sqlite3.Connection) -> float:
+        """BEGIN IMMEDIATE; возвращает, сколько секунд ждали блокировку записи"""
+        start = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        return time.perf_counter() - start
+
+    def trim_users(self, user_ids: List[int]) -> Dict:
+        """Обрезка истории пользователей до history_retention одной транзакцией"""
+        conn = self._connect()
+        lock_wait = self._begin_write(conn)
+        deleted = 0
+        try:
+            cursor = conn.cursor()
+            for user_id in user_ids:
+                deleted += self._trim_user(cursor, user_id, self.history_retention)
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        for user_id in user_ids:
+            self._forget_count(user_id)
+        return {"deleted": deleted, "user_ids": user_ids, "lock_wait": lock_wait}
+
+    def _delete_batch(self, condition: str, params: Tuple, batch_size: int) -> Dict:
+        """
+        Удаляет до batch_size сообщений, подходящих под condition, одной
+        короткой транзакцией. Возвращает число удалённых, затронутых
+        пользователей и время ожидания блокировки записи.
+        """
+        conn = self._connect()
+        lock_wait = self._begin_write(conn)
+        try:
+            rows = conn.execute(f'SELECT id, user_id FROM messages WHERE {condition} LIMIT ?',
+                                params + (batch_size,)).fetchall()
+            conn.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        user_ids = sorted({row[1] for row in rows})
+        for user_id in user_ids:
+            self._forget_count(user_id)
+        return {"deleted": len(rows), "user_ids": user_ids, "lock_wait": lock_wait}
+
+    def count_expired(self, days: int) -> int:
+        """Сколько сообщений старше days дней"""
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM messages WHERE timestamp < datetime('now', ?)", (f'-{days} days',)
+        ).fetchone()[0]
+
+    def delete_expired_batch(self, days: int, batch_size: int = DELETE_BATCH_ROWS) -> Dict:
+        """Порция очистки по времени: до batch_size сообщений старше days дней"""
+        return self._delete_batch("timestamp < datetime('now', ?)", (f'-{days} days',), batch_size)
+
+    def delete_user_messages_batch(self, user_id: int, batch_size: int = DELETE_BATCH_ROWS) -> Dict:
+        """Порция удаления сообщений пользователя"""
+        return self._delete_batch('user_id = ?', (user_id,), batch_size)
+
+    def optimize(self) -> None:
+        """PRAGMA optimize: обновляет статистику планировщика там, где она устарела"""
+        self._connect().execute('PRAGMA optimize')
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """
+        Возвращает файлу до pages свободных страниц (при auto_vacuum=INCREMENTAL);
+        возвращает число освобождённых страниц
+        """
+        conn = self._connect()
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        # execute() выполняет у этой прагмы только один шаг, то есть одну страницу
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def storage_stats(self) -> Dict:
+        conn = self._connect()
+        return {
+            "page_size": conn.execute('PRAGMA page_size').fetchone()[0],
+            "page_count": conn.execute('PRAGMA page_count').fetchone()[0],
+            "freelist_count": conn.execute('PRAGMA freelist_count').fetchone()[0],
+            # 0 — NONE, 1 — FULL, 2 — INCREMENTAL
+            "auto_vacuum": conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        }
 
     def get_recent_messages(self, user_id: int, limit: int = 50) -> List[Dict]:
-        """Получение последних сообщений пользователя"""
-        with sqlite3.connect(self.db_name) as conn:
+        """Получение последних сообщений пользователя (не больше history_retention)"""
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT message_text, bot_response, timestamp 
                 FROM messages 
                 WHERE user_id = ? 
-                ORDER BY timestamp DESC 
+                ORDER BY timestamp DESC, id DESC 
                 LIMIT ?
-            ''', (user_id, limit))
+            ''', (user_id, min(limit, self.history_retention)))
 
             messages = []
             for row in cursor.fetchall():
@@ -144,10 +613,120 @@ class TelegramDatabase:
 
             return messages[::-1]  # возвращаем в хронологическом порядке
 
+    @staticmethod
+    def fts_terms(text: str) -> List[str]:
+        """
+        Значимые слова текста для поиска по истории. Слова от FTS_PREFIX_CHARS
+        букв обрезаются до этой длины и ищутся по префиксу через префиксный
+        индекс messages_fts — грубая замена стемминга для русских окончаний.
+        """
+        terms = []
+        for word in FTS_WORD_RE.findall(text.lower()):
+            if len(word) < FTS_MIN_WORD_CHARS or word in FTS_STOP_WORDS or word.isdigit():
+                continue
+            term = word[:FTS_PREFIX_CHARS]
+            if term not in terms:
+                terms.append(term)
+        return terms[:FTS_MAX_TERMS]
+
+    @staticmethod
+    def _term_keys(text: Optional[str]) -> set:
+        """
+        Слова текста и их префиксы длины FTS_PREFIX_CHARS: слово fts_terms короче
+        префикса совпадает только со словом целиком, остальные — с префиксом
+        """
+        words = set(FTS_WORD_RE.findall((text or "").lower()))
+        return words | {word[:FTS_PREFIX_CHARS] for word in words if len(word) > FTS_PREFIX_CHARS}
+
+    @classmethod
+    def _rank_turns(cls, terms: List[str], turns: List[Dict], k: int) -> List[Dict]:
+        """
+        Ходы (в хронологическом порядке), где есть слова terms, по убыванию
+        суммы IDF совпавших слов среди них; слово в вопросе пользователя весит
+        вдвое больше, чем в ответе бота; при равенстве выше более новый ход
+        """
+        matches = []
+        frequency = dict.fromkeys(terms, 0)
+        for position, turn in enumerate(turns):
+            user_keys = cls._term_keys(turn['user_message'])
+            bot_keys = cls._term_keys(turn['bot_response'])
+            weights = {}
+            for term in terms:
+                weight = 2 if term in user_keys else 1 if term in bot_keys else 0
+                if weight:
+                    weights[term] = weight
+                    frequency[term] += 1
+            if weights:
+                matches.append((position, turn, weights))
+
+        scored = []
+        for position, turn, weights in matches:
+            score = sum(weight * math.log(1 + len(matches) / frequency[term]) for term, weight in weights.items())
+            scored.append((score, position, turn))
+        scored.sort(key=lambda item: item[:2], reverse=True)
+        return [turn for _, _, turn in scored[:k]]
+
+    @classmethod
+    def rank_relevant(cls, turns: List[Dict], question: str, k: int = 3) -> List[Dict]:
+        """
+        get_relevant_messages без индекса: поиск по уже прочитанным ходам
+        (например, из HistoryCache) в хронологическом порядке. id хода — его
+        номер в turns, по нему with_relevant восстанавливает порядок
+        """
+        terms = cls.fts_terms(question)
+        if not terms or k <= 0:
+            return []
+        numbered = [dict(turn, id=position) for position, turn in enumerate(turns)]
+        return cls._rank_turns(terms, numbered, k)
+
+    def get_relevant_messages(self, user_id: int, question: str, k: int = 3, skip_recent: int = 0) -> List[Dict]:
+        """
+        До k ходов из видимой истории пользователя (кроме skip_recent
+        последних), лучше всего подходящих к вопросу; самые подходящие первыми.
+        Нужен fts_index.
+
+        FTS5 только отбирает ходы пользователя, где есть хотя бы одно слово
+        вопроса (CROSS JOIN: иначе планировщик идёт от messages и повторяет
+        MATCH для каждой строки). bm25() для этого не годится: IDF каждого слова он считает по
+        всей таблице, и на префиксных запросах это миллисекунды. Кандидатов
+        единицы, поэтому они ранжируются здесь же (_rank_turns): IDF считается
+        по окну пользователя.
+        """
+        terms = self.fts_terms(question)
+        if not terms or k <= 0 or skip_recent >= self.history_retention:
+            return []
+        query = " OR ".join(f'"{term}"*' if len(term) >= FTS_PREFIX_CHARS else f'"{term}"' for term in terms)
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT m.id, m.message_text, m.bot_response, m.timestamp
+                FROM messages_fts f
+                CROSS JOIN messages m ON m.id = f.rowid
+                WHERE messages_fts MATCH ? AND m.user_id = ? AND m.id IN (
+                    SELECT id FROM messages
+                    WHERE user_id = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ? OFFSET ?
+                )
+            ''', (f'user_id:"{user_id}" AND ({query})', user_id, user_id,
+                  self.history_retention - skip_recent, skip_recent))
+            rows = cursor.fetchall()
+
+        turns = [{
+            'id': row[0],
+            'user_message': row[1],
+            'bot_response': row[2],
+            'timestamp': row[3]
+        } for row in sorted(rows)]
+        return self._rank_turns(terms, turns, k)
+
     def get_conversation_history(self, user_id: int, limit: int = 30) -> str:
         """Получение истории переписки в формате для RAG"""
-        messages = self.get_recent_messages(user_id, limit)
+        return self.format_history(self.get_recent_messages(user_id, limit))
 
+    @staticmethod
+    def format_history(messages: List[Dict]) -> str:
         history = []
         for msg in messages:
             history.append(f"User: {msg['user_message']}")
@@ -155,64 +734,147 @@ class TelegramDatabase:
 
         return "\n".join(history)
 
+    @staticmethod
+    def _clip(text: str, limit: int) -> str:
+        if len(text) <= limit:
+            return text
+        return text[:max(0, limit - 1)] + "…"
+
+    @staticmethod
+    def char_budget(max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> Optional[int]:
+        """Бюджет в символах: меньший из max_chars и max_tokens × CHARS_PER_TOKEN"""
+        budgets = [budget for budget in (max_chars, max_tokens * CHARS_PER_TOKEN if max_tokens is not None else None)
+                   if budget is not None]
+        return max(0, min(budgets)) if budgets else None
+
+    @classmethod
+    def budget_history(cls, messages: List[Dict], max_chars: Optional[int] = None,
+                       max_tokens: Optional[int] = None, truncate: bool = False) -> Dict:
+        """
+        История из самых новых ходов, которые целиком помещаются в бюджет
+        max_chars символов и/или max_tokens токенов (по CHARS_PER_TOKEN).
+        truncate=True — ход, который не помещается, сокращается до остатка
+        бюджета вместо того, чтобы на нём остановиться. Без бюджета результат
+        совпадает с format_history.
+        """
+        budget = cls.char_budget(max_chars, max_tokens)
+
+        blocks = []
+        used = 0
+        truncated = 0
+        for msg in reversed(messages):
+            user_message = msg['user_message'] or ""
+            bot_response = msg['bot_response'] or ""
+            separator = 1 if blocks else 0
+            size = separator + TURN_FORMAT_CHARS + len(user_message) + len(bot_response)
+            if budget is not None and used + size > budget:
+                room = budget - used - separator - TURN_FORMAT_CHARS
+                if not truncate or room < MIN_TRUNCATED_TURN_CHARS:
+                    break
+                # Вопросу не больше половины остатка, если ответу нужно больше
+                user_room = min(len(user_message), max(room // 2, room - len(bot_response)))
+                user_message = cls._clip(user_message, user_room)
+                bot_response = cls._clip(bot_response, room - len(user_message))
+                size = separator + TURN_FORMAT_CHARS + len(user_message) + len(bot_response)
+                truncated += 1
+            blocks.append(f"User: {user_message}\nBot: {bot_response}")
+            used += size
+            if truncated:
+                break
+
+        history = "\n".join(reversed(blocks))
+        return {
+            "history": history,
+            "turns": len(blocks),
+            "dropped": len(messages) - len(blocks),
+            "truncated": truncated,
+            "chars": len(history),
+            "tokens": -(-len(history) // CHARS_PER_TOKEN)
+        }
+
+    @classmethod
+    def with_relevant(cls, window: Dict, relevant: List[Dict], max_chars: Optional[int] = None) -> Dict:
+        """
+        Окно budget_history с добавленными перед ним релевантными ходами из
+        get_relevant_messages: берутся по порядку те, что целиком помещаются
+        в остаток max_chars, и выводятся в хронологическом порядке
+        """
+        used = window["chars"]
+        chosen = []
+        for msg in relevant:
+            size = TURN_FORMAT_CHARS + len(msg['user_message'] or "") + len(msg['bot_response'] or "") + 1
+            if max_chars is not None and used + size > max_chars:
+                continue
+            chosen.append(msg)
+            used += size
+        if not chosen:
+            return dict(window, relevant=0)
+
+        chosen.sort(key=lambda msg: msg['id'])
+        history = cls.format_history(chosen)
+        if window["history"]:
+            history += "\n" + window["history"]
+        return dict(
+            window,
+            history=history,
+            turns=window["turns"] + len(chosen),
+            dropped=max(0, window["dropped"] - len(chosen)),
+            relevant=len(chosen),
+            chars=len(history),
+            tokens=-(-len(history) // CHARS_PER_TOKEN)
+        )
+
     def get_user_stats(self, user_id: int) -> Dict:
         """Статистика пользователя"""
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
-            # Количество сообщений
-            cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
-            message_count = cursor.fetchone()[0]
-
-            # Первое сообщение
-            cursor.execute('SELECT MIN(timestamp) FROM messages WHERE user_id = ?', (user_id,))
-            first_message = cursor.fetchone()[0]
+            # Количество сообщений и первое из них в пределах видимой истории:
+            # до обрезки в базе может лежать больше history_retention сообщений
+            cursor.execute('''
+                SELECT COUNT(*), MIN(timestamp) FROM (
+                    SELECT timestamp FROM messages
+                    WHERE user_id = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                )
+            ''', (user_id, self.history_retention))
+            message_count, first_message = cursor.fetchone()
 
             return {
                 'message_count': message_count,
                 'first_interaction': first_message
             }
 
-    def cleanup_old_messages(self, days: int = 30):
-        """Очистка старых сообщений"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                DELETE FROM messages 
-                WHERE timestamp < datetime('now', ?)
-            ''', (f'-{days} days',))
-            conn.commit()
+    def cleanup_old_messages(self, days: int = 30) -> int:
+        """
+        Очистка старых сообщений порциями по DELETE_BATCH_ROWS, каждая в своей
+        транзакции; в сервисе её выполняет RetentionScheduler с паузами между
+        порциями. Возвращает число удалённых сообщений.
+        """
+        deleted = 0
+        while True:
+            batch = self.delete_expired_batch(days)
+            deleted += batch["deleted"]
+            if batch["deleted"] < DELETE_BATCH_ROWS:
+                return deleted
 
     def cleanup_old_messages_per_user(self, user_id: int, keep_count: int = 30):
         """Оставляет только последние keep_count сообщений для пользователя"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-
-            # Находим ID keep_count-го сообщения по времени
-            cursor.execute('''
-                SELECT id FROM messages 
-                WHERE user_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT 1 OFFSET ?
-            ''', (user_id, keep_count - 1))
-
-            result = cursor.fetchone()
-            if result:
-                # Удаляем все сообщения старше этого ID
-                cursor.execute('''
-                    DELETE FROM messages 
-                    WHERE user_id = ? AND id < ?
-                ''', (user_id, result[0]))
-
+        with self._connect() as conn:
+            self._trim_user(conn.cursor(), user_id, keep_count)
             conn.commit()
+        self._forget_count(user_id)
 
     def delete_user_data(self, user_id: int):
         """Удаление всех данных пользователя (сообщений и имени)"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        # Удаляем сообщения пользователя порциями
+        while self.delete_user_messages_batch(user_id)["deleted"] == DELETE_BATCH_ROWS:
+            pass
+        self._forget_count(user_id)
 
-            # Удаляем сообщения пользователя
-            cursor.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+        with self._connect() as conn:
+            cursor = conn.cursor()
 
             # Сбрасываем кастомное имя (остальные данные оставляем)
             cursor.execute('''
@@ -1,8 +1,72 @@
+import os
+import sqlite3
+from typing import Optional
+
 from database import TelegramDatabase
+from history_cache import HistoryCache
+from retention import RetentionScheduler
+from storage_executor import StorageBusyError, StorageExecutor
+from write_behind import WriteBehindBuffer
 from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel
 
-db = TelegramDatabase()
+# Сколько последних ходов пользователя видно в истории и доступно поиску по ней.
+# DB_HISTORY_FTS=1 — поиск по индексу FTS5 (его триггеры замедляют каждую запись
+# сообщения), по умолчанию ходы по вопросу ищутся в истории пользователя в памяти
+db = TelegramDatabase(
+    history_retention=int(os.getenv("DB_HISTORY_RETENTION", "30")),
+    fts_index=os.getenv("DB_HISTORY_FTS", "0") == "1"
+)
+
+# Доля бюджета истории под ходы, найденные по вопросу, когда в get_history передан query
+RELEVANT_SHARE = float(os.getenv("DB_RELEVANT_SHARE", "0.4"))
+
+# Один поток пишет, DB_READERS потоков читают; event loop не ждёт SQLite
+storage = StorageExecutor(
+    readers=int(os.getenv("DB_READERS", "4")),
+    max_pending=int(os.getenv("DB_MAX_PENDING", "1024"))
+)
+
+# Последние ходы пользователей в памяти, DB_HISTORY_CACHE_MB=0 отключает кэш
+cache = None
+if int(os.getenv("DB_HISTORY_CACHE_MB", "64")) > 0:
+    cache = HistoryCache(
+        max_bytes=int(os.getenv("DB_HISTORY_CACHE_MB", "64")) * 1024 * 1024,
+        retention=db.history_retention
+    )
+
+def cache_entry(entry):
+    if cache is not None:
+        cache.append(entry["user_id"], entry["message_text"], entry["bot_response"], entry["timestamp"])
+
+# DB_WRITE_BEHIND=1 — add_message отвечает после записи в журнал, в SQLite сообщения
+# переносятся пакетами каждые DB_FLUSH_INTERVAL_MS мс или по DB_FLUSH_ROWS штук
+buffer = None
+if os.getenv("DB_WRITE_BEHIND", "0") == "1":
+    buffer = WriteBehindBuffer(
+        db,
+        log_path=os.getenv("DB_WRITE_BEHIND_LOG", "write_behind.log"),
+        flush_interval_ms=int(os.getenv("DB_FLUSH_INTERVAL_MS", "50")),
+        flush_rows=int(os.getenv("DB_FLUSH_ROWS", "256")),
+        fsync_interval_ms=int(os.getenv("DB_LOG_FSYNC_MS", "0")),
+        writer=storage.writer,
+        on_append=cache_entry
+    )
+history = buffer if buffer is not None else db
+
+# Очистка по времени (DB_RETENTION_DAYS=0 — без неё), обрезка историй и обслуживание
+# файла порциями по DB_DELETE_BATCH сообщений с паузой DB_DELETE_PAUSE_MS между ними
+retention = RetentionScheduler(
+    db,
+    storage,
+    cache,
+    days=int(os.getenv("DB_RETENTION_DAYS", "30")),
+    interval_s=float(os.getenv("DB_RETENTION_INTERVAL_S", "3600")),
+    batch_size=int(os.getenv("DB_DELETE_BATCH", "250")),
+    pause_ms=float(os.getenv("DB_DELETE_PAUSE_MS", "20")),
+    optimize_interval_s=float(os.getenv("DB_OPTIMIZE_INTERVAL_S", "86400")),
+    vacuum_pages=int(os.getenv("DB_VACUUM_PAGES", "256"))
+)
 
 app = FastAPI(title="DB", docs_url=None, redoc_url=None, openapi_url=None)
 
@@ -29,45 +93,150 @@ class GetRecentMes(BaseModel):
     limit: int
 
 
+async def read(func, *args):
+    try:
+        return await storage.read(func, *args)
+    except StorageBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+async def write(func, *args):
+    try:
+        return await storage.write(func, *args)
+    except StorageBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+async def journal(func, *args):
+    try:
+        return await storage.append(func, *args)
+    except StorageBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def delete_user_data(user_id: int):
+    # Основную часть сообщений к этому моменту удалил retention.delete_user_messages.
+    # Несохранённые сообщения сначала попадают в базу, иначе перенос вернул бы их после удаления
+    if buffer is not None:
+        buffer.flush()
+    db.delete_user_data(user_id)
+    if cache is not None:
+        cache.invalidate(user_id)
+
+def add_message_now(user_id: int, message_text: str, bot_response: str):
+    # Выполняется в потоке-писателе, поэтому ходы попадают в кэш в порядке записи в базу
+    db.add_message(user_id, message_text, bot_response)
+    if cache is not None:
+        cache.append(user_id, message_text, bot_response)
+
+def get_recent_window(user_id: int, limit: int, max_chars: Optional[int], truncate: bool):
+    if cache is None:
+        return db.budget_history(history.get_recent_messages(user_id, limit), max_chars, truncate=truncate)
+    return cache.get_history(user_id, limit, history.get_recent_messages, max_chars, truncate)
+
+def get_relevant_turns(user_id: int, query: str, relevant: int, skip_recent: int):
+    if db.fts_index:
+        try:
+            return db.get_relevant_messages(user_id, query, relevant, skip_recent=skip_recent)
+        except sqlite3.OperationalError:
+            # Запрос, который FTS5 не разобрал, не должен лишать пользователя истории
+            return []
+    # Без индекса: видимая история пользователя из кэша (или из базы), кроме окна
+    if cache is None:
+        turns = history.get_recent_messages(user_id, db.history_retention)
+    else:
+        turns = cache.get_turns(user_id, history.get_recent_messages)
+    return db.rank_relevant(turns[:max(0, len(turns) - skip_recent)], query, relevant)
+
+def get_history_window(user_id: int, limit: int, max_chars: Optional[int], truncate: bool,
+                       query: Optional[str], relevant: int):
+    if not query or relevant <= 0:
+        return get_recent_window(user_id, limit, max_chars, truncate)
+
+    # Последним ходам остаётся часть бюджета, остальное — ходам, найденным по вопросу.
+    # Из поиска исключаются ходы, уже попавшие в окно (в режиме write-behind с FTS5 с
+    # запасом: ещё не перенесённые сообщения в индекс не попадают)
+    recent_chars = None if max_chars is None else int(max_chars * (1 - RELEVANT_SHARE))
+    window = get_recent_window(user_id, limit, recent_chars, truncate)
+    matches = get_relevant_turns(user_id, query, relevant, window["turns"])
+    if not matches:
+        window = get_recent_window(user_id, limit, max_chars, truncate)
+    return db.with_relevant(window, matches, max_chars)
+
+@app.on_event("startup")
+async def on_startup():
+    if buffer is not None:
+        buffer.start()
+    retention.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await retention.stop()
+    if buffer is not None:
+        buffer.shutdown()
+    storage.shutdown()
+    db.close()
+
+
 @app.post("/database/add_user")
 async def add_user(new_user: NewUser, request: Request):
-    db.add_user(
-        user_id=new_user.user_id,
-        username=new_user.username,
-        first_name=new_user.first_name,
-        last_name=new_user.last_name
+    await write(
+        db.add_user,
+        new_user.user_id,
+        new_user.username,
+        new_user.first_name,
+        new_user.last_name
     )
 
     return {"status": "ok"}
 
+@app.get('/database/metrics')
+async def metrics():
+    return {
+        "storage": storage.stats(),
+        "profiles": db.profile_stats(),
+        "write_behind": buffer.stats() if buffer is not None else None,
+        "history_cache": cache.stats() if cache is not None else None,
+        "retention": retention.stats(),
+        "file": await read(db.storage_stats)
+    }
+
 @app.get('/database/get_user_name/{user_id}')
 async def get_user_name(user_id: int, request: Request):
-    user_name = db.get_user_name(user_id)
+    user_name = await read(db.get_user_name, user_id)
 
     return {"user_name": user_name}
 
 @app.patch("/database/update_user_name")
 async def update_user_name(new_name: UpdateUsername, request: Request):
-    db.update_user_name(new_name.user_id, new_name.username)
+    await write(db.update_user_name, new_name.user_id, new_name.username)
 
     return {"status": "ok"}
 
 @app.delete('/database/delete_user/{user_id}')
 async def delete_user(user_id: int):
-    db.delete_user_data(user_id)
+    # Порциями, между ними проходят записи других пользователей
+    try:
+        await retention.delete_user_messages(user_id)
+    except StorageBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    await write(delete_user_data, user_id)
     return {"status": "ok"}
 
 @app.get('/database/get_history/{user_id}')
-async def get_history(user_id: int, limit: int = 50):
-    chat_history = db.get_conversation_history(user_id, limit)
-    response = {
-    "history": chat_history
-    }
+async def get_history(user_id: int, limit: int = 50, max_chars: Optional[int] = None,
+                      max_tokens: Optional[int] = None, truncate: bool = False,
+                      query: Optional[str] = None, relevant: int = 3):
+    # Самые новые ходы, которые помещаются в max_chars символов / max_tokens токенов;
+    # truncate=true сокращает ход, который целиком не помещается. С query перед ними
+    # добавляются до relevant более ранних ходов, найденных по тексту вопроса
+    max_chars = db.char_budget(max_chars, max_tokens)
+    window = await read(get_history_window, user_id, limit, max_chars, truncate, query, relevant)
 
-    return response
+    return window
 
 @app.post('/database/add_message/')
 async def add_message(message: NewMessage, request: Request):
-    db.add_message(message.user_id, message.message_text, message.bot_response)
+    if buffer is not None:
+        await journal(buffer.append, message.user_id, message.message_text, message.bot_response)
+    else:
+        await write(add_message_now, message.user_id, message.message_text, message.bot_response)
 
     return {"status": "ok"}
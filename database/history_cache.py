@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import TelegramDatabase
+
+# Примерные накладные расходы на один ход в памяти: словарь, строки, узел deque
+TURN_OVERHEAD_BYTES = 400
+USER_OVERHEAD_BYTES = 1000
+# Счётчики записей по корзинам пользователей: загрузка из базы не кладёт в кэш
+# историю, если за время чтения в её корзину что-то записали
+WRITE_BUCKETS = 4096
+
+
+def _turn_size(message: Dict) -> int:
+    return len(message['user_message'] or "") + len(message['bot_response'] or "") + TURN_OVERHEAD_BYTES
+
+
+class _UserHistory:
+    __slots__ = ("turns", "formatted", "size")
+
+    def __init__(self, turns: List[Dict], retention: int):
+        self.turns = deque(turns, maxlen=retention)
+        # Готовые окна истории по (limit, max_chars, truncate)
+        self.formatted: Dict[Tuple, Dict] = {}
+        self.size = USER_OVERHEAD_BYTES + sum(_turn_size(turn) for turn in self.turns)
+
+
+class HistoryCache:
+    """
+    Последние ходы переписки по пользователям в памяти процесса.
+
+    У каждого пользователя кольцевой буфер из retention последних ходов
+    (столько же видно в базе) и готовые окна истории из budget_history для
+    запрошенных limit и бюджета. add_message дописывает ход в буфер и
+    сбрасывает окна, delete_user_data удаляет буфер. Общий объём ограничен max_bytes,
+    при превышении вытесняются давно не читавшиеся пользователи.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, retention: int = 30):
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.bytes = 0
+        self._users: "OrderedDict[int, _UserHistory]" = OrderedDict()
+        self._write_counters = [0] * WRITE_BUCKETS
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "memo_hits": 0, "appends": 0,
+                       "invalidations": 0, "evictions": 0, "stale_loads": 0}
+
+    def _resize(self, user_id: int, entry: _UserHistory, delta: int) -> None:
+        entry.size += delta
+        self.bytes += delta
+        while self.bytes > self.max_bytes and self._users:
+            evicted_id, evicted = self._users.popitem(last=False)
+            self.bytes -= evicted.size
+            self._stats["evictions"] += 1
+            if evicted_id == user_id:
+                break
+
+    def get_history(self, user_id: int, limit: int, load: Callable[[int, int], List[Dict]],
+                    max_chars: Optional[int] = None, truncate: bool = False) -> Dict:
+        """
+        Окно истории (см. TelegramDatabase.budget_history) из limit последних
+        ходов; при промахе load(user_id, retention) читает их из базы
+        """
+        limit = max(0, min(limit, self.retention))
+        key = (limit, max_chars, truncate)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+                self._stats["hits"] += 1
+                window = entry.formatted.get(key)
+                if window is not None:
+                    self._stats["memo_hits"] += 1
+                    return window
+                turns = list(entry.turns)
+                window = TelegramDatabase.budget_history(turns[max(0, len(turns) - limit):], max_chars,
+                                                         truncate=truncate)
+                entry.formatted[key] = window
+                self._resize(user_id, entry, window["chars"])
+                return window
+            self._stats["misses"] += 1
+            bucket = user_id % WRITE_BUCKETS
+            counter = self._write_counters[bucket]
+
+        messages = load(user_id, self.retention)
+        window = TelegramDatabase.budget_history(messages[max(0, len(messages) - limit):], max_chars,
+                                                 truncate=truncate)
+
+        with self._lock:
+            if self._write_counters[bucket] != counter:
+                # Пока читали базу, пользователю из этой корзины дописали сообщение
+                self._stats["stale_loads"] += 1
+            elif user_id not in self._users:
+                entry = _UserHistory(messages, self.retention)
+                entry.formatted[key] = window
+                self._users[user_id] = entry
+                self.bytes += entry.size
+                self._resize(user_id, entry, window["chars"])
+        return window
+
+    def get_turns(self, user_id: int, load: Callable[[int, int], List[Dict]]) -> List[Dict]:
+        """retention последних ходов в хронологическом порядке, при промахе — через load, как в get_history"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+                self._stats["hits"] += 1
+                return list(entry.turns)
+            self._stats["misses"] += 1
+            bucket = user_id % WRITE_BUCKETS
+            counter = self._write_counters[bucket]
+
+        messages = load(user_id, self.retention)
+
+        with self._lock:
+            if self._write_counters[bucket] != counter:
+                self._stats["stale_loads"] += 1
+            elif user_id not in self._users:
+                entry = _UserHistory(messages, self.retention)
+                self._users[user_id] = entry
+                self.bytes += entry.size
+                self._resize(user_id, entry, 0)
+        return messages
+
+    def append(self, user_id: int, message_text: str, bot_response: str, timestamp: str = None) -> None:
+        """Вызывается после записи сообщения, в том же порядке, в каком сообщения попали в базу"""
+        with self._lock:
+            self._write_counters[user_id % WRITE_BUCKETS] += 1
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            turn = {
+                'user_message': message_text,
+                'bot_response': bot_response,
+                'timestamp': timestamp
+            }
+            delta = _turn_size(turn) - sum(window["chars"] for window in entry.formatted.values())
+            if len(entry.turns) == entry.turns.maxlen:
+                delta -= _turn_size(entry.turns[0])
+            entry.turns.append(turn)
+            entry.formatted.clear()
+            self._stats["appends"] += 1
+            self._resize(user_id, entry, delta)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._write_counters[user_id % WRITE_BUCKETS] += 1
+            entry = self._users.pop(user_id, None)
+            if entry is not None:
+                self.bytes -= entry.size
+                self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        """Сброс всех буферов, например после очистки старых сообщений в базе"""
+        with self._lock:
+            self._write_counters = [counter + 1 for counter in self._write_counters]
+            self._users.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["users"] = len(self._users)
+            stats["bytes"] = self.bytes
+        reads = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / reads if reads else 0.0
+        return stats
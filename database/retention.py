@@ -0,0 +1,178 @@
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+
+from database import DELETE_BATCH_ROWS, TelegramDatabase
+from history_cache import HistoryCache
+from storage_executor import StorageExecutor
+
+
+class RetentionScheduler:
+    """
+    Фоновые задачи хранения в event loop сервиса базы.
+
+    Раз в interval_s секунд удаляются сообщения старше days дней, затем
+    история пользователей обрезается до history_retention. Удаление идёт
+    порциями по batch_size сообщений: каждая порция — отдельная короткая
+    транзакция в потоке-писателе StorageExecutor, между порциями пауза
+    pause_ms. Записи из эндпоинтов, вставшие в очередь писателя, ждут не
+    всю очистку, а не больше одной порции. Раз в optimize_interval_s —
+    PRAGMA optimize и incremental_vacuum по vacuum_pages страниц за порцию.
+
+    Тем же способом порциями удаляются сообщения пользователя по запросу
+    (delete_user_messages).
+    """
+
+    def __init__(self, db: TelegramDatabase, storage: StorageExecutor, cache: Optional[HistoryCache] = None,
+                 days: int = 30, interval_s: float = 3600, batch_size: int = DELETE_BATCH_ROWS,
+                 pause_ms: float = 20, optimize_interval_s: float = 86400, vacuum_pages: int = 256):
+        self.db = db
+        self.storage = storage
+        self.cache = cache
+        self.days = days
+        self.interval = interval_s
+        self.batch_size = batch_size
+        self.pause = pause_ms / 1000
+        self.optimize_interval = optimize_interval_s
+        self.vacuum_pages = vacuum_pages
+
+        self._task: Optional[asyncio.Task] = None
+        self._last_optimize: Optional[float] = None
+        self._stats = {"runs": 0, "errors": 0, "batches": 0, "deleted": 0, "trimmed": 0,
+                       "batch_seconds": 0.0, "max_batch_seconds": 0.0,
+                       "lock_wait_seconds": 0.0, "max_lock_wait_seconds": 0.0,
+                       "optimizes": 0, "vacuumed_pages": 0, "last_run_seconds": 0.0}
+        self.last_error: Optional[str] = None
+        # Текущая задача: сколько из total уже сделано (сообщений, для compact — пользователей)
+        self.progress = {"job": None, "done": 0, "total": None}
+
+    @staticmethod
+    def _timed(func: Callable, args):
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    async def _batch(self, func: Callable, *args):
+        """Одна порция в потоке-писателе, затем пауза, чтобы прошли записи из эндпоинтов"""
+        result, seconds = await self.storage.maintenance(self._timed, func, args)
+        self._stats["batches"] += 1
+        self._stats["batch_seconds"] += seconds
+        self._stats["max_batch_seconds"] = max(self._stats["max_batch_seconds"], seconds)
+        if isinstance(result, dict) and "lock_wait" in result:
+            self._stats["lock_wait_seconds"] += result["lock_wait"]
+            self._stats["max_lock_wait_seconds"] = max(self._stats["max_lock_wait_seconds"], result["lock_wait"])
+        await asyncio.sleep(self.pause)
+        return result
+
+    def _begin(self, job: str, total: Optional[int]) -> None:
+        self.progress = {"job": job, "done": 0, "total": total}
+
+    async def purge_expired(self) -> int:
+        """Удаление сообщений старше days дней"""
+        self._begin("expire", await self.storage.read(self.db.count_expired, self.days))
+        deleted = 0
+        while True:
+            result = await self._batch(self.db.delete_expired_batch, self.days, self.batch_size)
+            deleted += result["deleted"]
+            self.progress["done"] = deleted
+            self._stats["deleted"] += result["deleted"]
+            # Удалённые сообщения могли быть в видимой истории
+            if self.cache is not None:
+                for user_id in result["user_ids"]:
+                    self.cache.invalidate(user_id)
+            if result["deleted"] < self.batch_size:
+                return deleted
+
+    async def compact(self) -> int:
+        """Обрезка историй длиннее history_retention, по batch_size сообщений за порцию"""
+        user_ids = await self.storage.read(self.db.users_over_retention)
+        self._begin("compact", len(user_ids))
+        # Сверх history_retention у пользователя не больше trim_threshold - history_retention сообщений
+        step = max(1, self.batch_size // max(1, self.db.trim_threshold - self.db.history_retention))
+        trimmed = 0
+        for start in range(0, len(user_ids), step):
+            result = await self._batch(self.db.trim_users, user_ids[start:start + step])
+            trimmed += result["deleted"]
+            self.progress["done"] = min(len(user_ids), start + step)
+            self._stats["trimmed"] += result["deleted"]
+        return trimmed
+
+    async def delete_user_messages(self, user_id: int) -> int:
+        """Удаление всех сообщений пользователя порциями"""
+        deleted = 0
+        while True:
+            result = await self._batch(self.db.delete_user_messages_batch, user_id, self.batch_size)
+            deleted += result["deleted"]
+            self._stats["deleted"] += result["deleted"]
+            if result["deleted"] < self.batch_size:
+                return deleted
+
+    async def maintain(self) -> None:
+        """PRAGMA optimize и возврат свободных страниц файлу"""
+        self._begin("optimize", None)
+        await self._batch(self.db.optimize)
+        self._stats["optimizes"] += 1
+        if self.vacuum_pages <= 0:
+            return
+        self._begin("vacuum", (await self.storage.read(self.db.storage_stats))["freelist_count"])
+        while True:
+            freed = await self._batch(self.db.incremental_vacuum, self.vacuum_pages)
+            self.progress["done"] += freed
+            self._stats["vacuumed_pages"] += freed
+            if freed < self.vacuum_pages:
+                return
+
+    async def run_once(self) -> None:
+        start = time.perf_counter()
+        if self.days > 0:
+            await self.purge_expired()
+        await self.compact()
+        now = time.monotonic()
+        if self._last_optimize is None or now - self._last_optimize >= self.optimize_interval:
+            await self.maintain()
+            self._last_optimize = now
+        self._begin(None, None)
+        self._stats["runs"] += 1
+        self._stats["last_run_seconds"] = time.perf_counter() - start
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Например, StorageBusyError при переполненной очереди: продолжим в следующий раз
+                self._stats["errors"] += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """Запуск в текущем event loop"""
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        batches = stats.pop("batches")
+        batch_seconds = stats.pop("batch_seconds")
+        lock_wait_seconds = stats.pop("lock_wait_seconds")
+        stats.update({
+            "batches": batches,
+            "avg_batch_ms": batch_seconds / batches * 1000 if batches else 0.0,
+            "max_batch_ms": stats.pop("max_batch_seconds") * 1000,
+            "avg_lock_wait_ms": lock_wait_seconds / batches * 1000 if batches else 0.0,
+            "max_lock_wait_ms": stats.pop("max_lock_wait_seconds") * 1000,
+            "progress": dict(self.progress),
+            "last_error": self.last_error
+        })
+        return stats
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+
+class StorageBusyError(Exception):
+    pass
+
+
+class StorageExecutor:
+    """
+    Вызовы TelegramDatabase вне event loop.
+
+    Все записи идут через один поток-писатель: SQLite всё равно допускает
+    одного писателя, и очередь в процессе дешевле ожидания busy_timeout.
+    Чтения выполняет пул из readers потоков; в режиме WAL они не ждут
+    писателя. У каждого потока своё постоянное соединение из
+    ConnectionManager. Одновременно в очереди не больше max_pending вызовов,
+    остальные получают StorageBusyError.
+
+    Отдельный пул journal_threads потоков — журнал write-behind: дозапись в
+    файл не ждёт транзакций писателя, а одновременные дозаписи делят fsync.
+
+    maintenance() — порции фоновых задач хранения: тот же поток-писатель,
+    но отдельная статистика.
+    """
+
+    def __init__(self, readers: int = 4, max_pending: int = 1024, journal_threads: int = 8):
+        self.readers = readers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.journal = ThreadPoolExecutor(max_workers=journal_threads, thread_name_prefix="db-journal")
+        self._lock = threading.Lock()
+        self._stats = {
+            kind: {"calls": 0, "wait_seconds": 0.0, "run_seconds": 0.0, "max_wait_seconds": 0.0}
+            for kind in ("read", "write", "journal", "maintenance")
+        }
+        self._rejected = 0
+
+    def _timed(self, kind: str, func: Callable, args, queued_at: float):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                stats = self._stats[kind]
+                stats["calls"] += 1
+                stats["wait_seconds"] += started - queued_at
+                stats["run_seconds"] += finished - started
+                stats["max_wait_seconds"] = max(stats["max_wait_seconds"], started - queued_at)
+
+    async def _run(self, kind: str, executor: ThreadPoolExecutor, func: Callable, *args):
+        if self.pending >= self.max_pending:
+            self._rejected += 1
+            raise StorageBusyError("Очередь запросов к базе переполнена")
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, self._timed, kind, func, args, time.perf_counter())
+        finally:
+            self.pending -= 1
+
+    async def read(self, func: Callable, *args):
+        return await self._run("read", self.reader_pool, func, *args)
+
+    async def write(self, func: Callable, *args):
+        return await self._run("write", self.writer, func, *args)
+
+    async def append(self, func: Callable, *args):
+        return await self._run("journal", self.journal, func, *args)
+
+    async def maintenance(self, func: Callable, *args):
+        return await self._run("maintenance", self.writer, func, *args)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {"pending": self.pending, "rejected": self._rejected}
+            for kind, stats in self._stats.items():
+                calls = stats["calls"]
+                result[kind] = {
+                    "calls": calls,
+                    "avg_wait_ms": stats["wait_seconds"] / calls * 1000 if calls else 0.0,
+                    "max_wait_ms": stats["max_wait_seconds"] * 1000,
+                    "avg_run_ms": stats["run_seconds"] / calls * 1000 if calls else 0.0
+                }
+            return result
+
+    def shutdown(self) -> None:
+        self.journal.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        self.reader_pool.shutdown(wait=True)
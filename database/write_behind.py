@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Executor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from database import TelegramDatabase
+
+
+def _datasync(fileno: int) -> None:
+    # fdatasync не сбрасывает время изменения файла, этого достаточно для журнала
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fileno)
+    else:
+        os.fsync(fileno)
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись сообщений в SQLite.
+
+    append() дописывает сообщение строкой JSON в журнал на диске и сразу
+    возвращает управление; фоновый поток переносит накопленное в messages
+    одной транзакцией каждые flush_interval_ms или по набору flush_rows
+    сообщений. Вместе с пакетом в базе сохраняется номер последней записи
+    журнала, поэтому после падения процесса start() дописывает в базу ровно
+    то, что не успело в неё попасть.
+
+    fsync_interval_ms=0 — сообщение подтверждается после fsync журнала;
+    одновременные append() из разных потоков ждут общего fsync (group
+    commit). Больше нуля — fsync раз в интервал: при отключении питания
+    теряется не больше интервала, падение процесса данных не теряет.
+
+    Чтения истории через этот объект видят и ещё не перенесённые сообщения.
+    """
+
+    def __init__(self, db: TelegramDatabase, log_path: str, flush_interval_ms: int = 50,
+                 flush_rows: int = 256, fsync_interval_ms: int = 0, max_log_bytes: int = 8 * 1024 * 1024,
+                 writer: Optional[Executor] = None, on_append: Optional[Callable[[Dict], None]] = None):
+        self.db = db
+        self.log_path = log_path
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_rows = flush_rows
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.max_log_bytes = max_log_bytes
+        # Пакеты пишутся через поток-писатель StorageExecutor, если он передан
+        self.writer = writer
+        # Вызывается под блокировкой журнала, то есть в порядке номеров записей
+        self.on_append = on_append
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self.synced_seq = 0
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._log = None
+        self._seq = 0
+        self.flushed_seq = 0
+        self._generation = 0
+        # Ещё не перенесённые записи: по порядку и по пользователям
+        self._pending: List[Dict] = []
+        self._pending_by_user: Dict[int, List[Dict]] = {}
+        self._stats = {"appended": 0, "fsyncs": 0, "flushes": 0, "flushed_rows": 0,
+                       "flush_seconds": 0.0, "recovered": 0}
+        self._started_at = time.monotonic()
+
+    def start(self) -> int:
+        """Восстановление из журнала и запуск фонового переноса; возвращает число восстановленных сообщений"""
+        self.flushed_seq = self.db.write_behind_seq()
+        recovered = self._read_log()
+        if recovered:
+            self.db.add_messages([self._row(entry) for entry in recovered], recovered[-1]["seq"])
+            self.flushed_seq = recovered[-1]["seq"]
+        self._seq = max(self.flushed_seq, self._seq)
+        self._stats["recovered"] = len(recovered)
+
+        self._log = open(self.log_path, "w", encoding="utf-8")
+        self._fsync()
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        return len(recovered)
+
+    def _read_log(self) -> List[Dict]:
+        if not os.path.exists(self.log_path):
+            return []
+        entries = []
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка: append() не успел вернуть управление
+                    break
+                self._seq = max(self._seq, entry["seq"])
+                if entry["seq"] > self.flushed_seq:
+                    entries.append(entry)
+        return entries
+
+    @staticmethod
+    def _row(entry: Dict):
+        return entry["user_id"], entry["message_text"], entry["bot_response"], entry["timestamp"]
+
+    def _fsync(self) -> None:
+        self._log.flush()
+        _datasync(self._log.fileno())
+        self._stats["fsyncs"] += 1
+
+    def _sync_through(self, seq: int) -> None:
+        """fsync журнала до записи seq; один fsync покрывает всех, кто ждал его"""
+        if self.synced_seq >= seq:
+            return
+        with self._sync_lock:
+            if self.synced_seq >= seq:
+                return
+            with self._lock:
+                self._log.flush()
+                target = self._seq
+                fileno = self._log.fileno()
+            _datasync(fileno)
+            with self._lock:
+                self._stats["fsyncs"] += 1
+            self.synced_seq = target
+
+    def append(self, user_id: int, message_text: str, bot_response: str) -> int:
+        """Запись сообщения в журнал; после возврата оно переживёт падение процесса"""
+        with self._lock:
+            self._seq += 1
+            entry = {
+                "seq": self._seq,
+                "user_id": user_id,
+                "message_text": message_text,
+                "bot_response": bot_response,
+                # Формат CURRENT_TIMESTAMP: время сообщения, а не момента переноса в базу
+                "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            self._log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._log.flush()
+            self._pending.append(entry)
+            self._pending_by_user.setdefault(user_id, []).append(entry)
+            self._stats["appended"] += 1
+            if self.on_append is not None:
+                self.on_append(entry)
+            if len(self._pending) >= self.flush_rows:
+                self._wakeup.set()
+        if self.fsync_interval <= 0:
+            self._sync_through(entry["seq"])
+        return entry["seq"]
+
+    def _run(self) -> None:
+        wait = min(self.flush_interval, self.fsync_interval) if self.fsync_interval > 0 else self.flush_interval
+        last_flush = time.monotonic()
+        while not self._stopped.is_set():
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+            if self.fsync_interval > 0:
+                self._sync_through(self._seq)
+            if len(self._pending) >= self.flush_rows or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_via_writer()
+                last_flush = time.monotonic()
+
+    def _flush_via_writer(self) -> None:
+        if self.writer is None:
+            self.flush()
+        else:
+            self.writer.submit(self.flush).result()
+
+    def flush(self) -> int:
+        """Перенос всех накопленных сообщений в базу в текущем потоке"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+                if not batch:
+                    return 0
+                # Нечётное поколение — пакет переносится, читатели ждут его завершения
+                self._generation += 1
+
+            start = time.perf_counter()
+            try:
+                self.db.add_messages([self._row(entry) for entry in batch], batch[-1]["seq"])
+            except Exception:
+                with self._lock:
+                    self._generation += 1
+                raise
+
+            with self._lock:
+                self._generation += 1
+                self.flushed_seq = batch[-1]["seq"]
+                del self._pending[:len(batch)]
+                for entry in batch:
+                    entries = self._pending_by_user.get(entry["user_id"])
+                    if entries and entries[0] is entry:
+                        entries.pop(0)
+                        if not entries:
+                            del self._pending_by_user[entry["user_id"]]
+                self._compact_log()
+                self._stats["flushes"] += 1
+                self._stats["flushed_rows"] += len(batch)
+                self._stats["flush_seconds"] += time.perf_counter() - start
+            return len(batch)
+
+    def _compact_log(self) -> None:
+        """Журнал обнуляется, когда всё перенесено, или переписывается, когда вырос сверх max_log_bytes"""
+        if not self._pending:
+            self._log.truncate(0)
+            self._log.seek(0)
+            self._fsync()
+            self.synced_seq = self._seq
+        elif self._log.tell() > self.max_log_bytes and self._sync_lock.acquire(blocking=False):
+            # Журнал переоткрывается, поэтому нужен _sync_lock; если идёт fsync,
+            # перепишем при следующем переносе
+            try:
+                self._rewrite_log()
+            finally:
+                self._sync_lock.release()
+
+    def _rewrite_log(self) -> None:
+        tmp_path = self.log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_path)
+        self._log.close()
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self._fsync()
+        self.synced_seq = self._seq
+
+    def get_recent_messages(self, user_id: int, limit: int = 50) -> List[Dict]:
+        """История из базы вместе с ещё не перенесёнными сообщениями"""
+        limit = min(limit, self.db.history_retention)
+        while True:
+            with self._lock:
+                generation = self._generation
+                pending = list(self._pending_by_user.get(user_id, ()))
+            if generation % 2:
+                time.sleep(0.001)
+                continue
+            stored = self.db.get_recent_messages(user_id, limit)
+            # Если пакет попал в базу между снимками, его строки оказались бы
+            # и в stored, и в pending — читаем заново
+            if self._generation == generation:
+                break
+        messages = stored + [{
+            'user_message': entry["message_text"],
+            'bot_response': entry["bot_response"],
+            'timestamp': entry["timestamp"]
+        } for entry in pending]
+        return messages[-limit:] if limit > 0 else []
+
+    def get_conversation_history(self, user_id: int, limit: int = 30) -> str:
+        return self.db.format_history(self.get_recent_messages(user_id, limit))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        stats["fsyncs_per_second"] = stats["fsyncs"] / elapsed
+        stats["avg_flush_rows"] = stats["flushed_rows"] / stats["flushes"] if stats["flushes"] else 0.0
+        stats["avg_flush_ms"] = stats["flush_seconds"] / stats["flushes"] * 1000 if stats["flushes"] else 0.0
+        return stats
+
+    def shutdown(self) -> None:
+        """Остановка фонового потока и перенос оставшегося"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._log is not None:
+            with self._lock:
+                self._fsync()
+                self._log.close()
+                self._log = None
@@ -6,6 +6,12 @@ RAG_URL = os.getenv("RAG_URL", "http://rag:8002/rag/") # "http://localhost:8002/
 AGENT_URL = os.getenv("AGENT_URL", "http://agent:8003/agent/") # "http://localhost:8003/agent/"
 AUDIT_URL = os.getenv("AUDIT_URL", "http://audit:8004/audit/") # "http://localhost:8004/audit/"
 DB_URL = os.getenv("DB_URL", "http://db:8005") # "http://localhost:8005"
+# Бюджет истории переписки в промпте агента, в токенах (оценка на стороне db)
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "2000"))
+# Поиску по истории хватает начала вопроса (он берёт не больше 16 слов), а вся строка
+# в URL GET-запроса может превысить предел длины строки запроса у сервера: кириллица
+# в URL занимает 6 байт на букву
+HISTORY_QUERY_MAX_CHARS = int(os.getenv("HISTORY_QUERY_MAX_CHARS", "500"))
 
 # log request
 def audit_log(service: str, level: str, message: str):
@@ -139,11 +145,16 @@ def delete_user(user_id: int):
 
 
 # get chat history
-def get_history(user_id: int, limit: int = 50):
+def get_history(user_id: int, limit: int = 50, max_tokens: int = HISTORY_MAX_TOKENS, query: str = None):
     try:
+        # Новейшие ходы, которые помещаются в max_tokens; слишком длинный ход сокращается.
+        # С query в историю добавляются и более ранние ходы, подходящие к вопросу
+        params = {"limit": limit, "max_tokens": max_tokens, "truncate": "true"}
+        if query:
+            params["query"] = query[:HISTORY_QUERY_MAX_CHARS]
         resp = requests.get(
             f"{DB_URL}/database/get_history/{user_id}", 
-            params={"limit": limit}, timeout=5
+            params=params, timeout=5
         )
 
         resp.raise_for_status()
@@ -185,7 +185,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         # Получаем историю переписки для контекста
-        conversation_history = api_requests.get_history(user.id, limit=50) 
+        conversation_history = api_requests.get_history(user.id, limit=50, query=user_message)
 
         # Формируем персонализированный запрос
         contextual_message = f"Пользователь: {user_name or 'User'}\n"
@@ -194,7 +194,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         contextual_message += f"Новый вопрос: {user_message}"
 
         # Данные из бд для response
-        chat_history = api_requests.get_history(user.id) 
+        chat_history = conversation_history
         user_name = api_requests.get_user_name(user.id) 
 
         # Данные модели RAG для response
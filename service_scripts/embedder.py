@@ -0,0 +1,34 @@
+from yandex_cloud_ml_sdk import YCloudML
+import numpy as np
+from scipy.spatial.distance import cdist
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from pathlib import Path
+
+# Импорт и настройка переменных окружения
+load_dotenv()
+
+FOLDER_ID = os.getenv('FOLDER_ID')
+API_KEY = os.getenv('API_KEY_EMBEDDER')
+
+sdk = YCloudML(folder_id=FOLDER_ID, auth=API_KEY)
+
+# выбрать модель: query (короткие промпты) или doc (длинные тексты)
+query_model = sdk.models.text_embeddings("query")  # эквивалент emb://.../text-search-query/latest
+doc_model = sdk.models.text_embeddings("doc")      # emb://.../text-search-doc/latest
+
+def get_embedding_textsdk(text: str, text_type: str = "query") -> np.ndarray:
+    model = query_model if text_type == "query" else doc_model
+    emb = model.run(text)  # возвращает list[float]
+    return np.array(emb, dtype=np.float32)
+
+
+# SDK эмбеддит по одному тексту, поэтому пакет отправляется параллельными запросами
+_batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('EMBEDDER_MAX_CONCURRENCY', '8')))
+
+def get_embeddings_textsdk(texts: list, text_type: str = "query") -> np.ndarray:
+    return np.stack(list(_batch_executor.map(lambda text: get_embedding_textsdk(text, text_type), texts)))
+
+
+#print(get_embedding_textsdk("Сырный суп"))
@@ -0,0 +1,163 @@
+"""
+Таблицы нормализации для деобфускации промптов.
+
+Таблицы для str.translate строятся один раз при импорте (проход по BMP
+занимает порядка 15 мс):
+- INVISIBLE_FOLD_TABLE за один проход удаляет невидимые символы формата
+  (zero-width, soft hyphen, теги U+E0000), снимает диакритику с латинских
+  букв и приводит текст к нижнему регистру;
+- TO_LATIN_TABLE и TO_CYRILLIC_TABLE приводят похожие символы и leet-замены
+  к латинице или к кириллице. Они применяются только к словам со смешением
+  алфавитов, направление выбирается по буквам, которые есть только в одном
+  из алфавитов, так что обычный русский текст не меняется.
+
+CONFUSABLES_FILE может указывать на confusables.txt из Unicode: его
+односимвольные отображения в латиницу дополняют встроенную таблицу.
+"""
+import os
+import re
+import unicodedata
+
+LEET = {'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's'}
+# Leet внутри кириллического слова: цифры заменяют русские буквы
+CYRILLIC_LEET = {'0': 'о', '3': 'з', '4': 'ч', '6': 'б', '@': 'а'}
+
+# Строчные русские буквы, похожие на латинские (в том числе после приведения
+# заглавных к нижнему регистру: В, К, М, Н, Т)
+RUSSIAN_CONFUSABLES = {
+    'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o',
+    'р': 'p', 'с': 'c', 'т': 't', 'у': 'y', 'х': 'x',
+}
+
+# Символы других алфавитов, которых нет в русском тексте: их появление в слове
+# уже признак обфускации
+FOREIGN_CONFUSABLES = {
+    # кириллица вне русского алфавита
+    'і': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w', 'һ': 'h', 'ӏ': 'l',
+    'ү': 'y', 'ҽ': 'e', 'ԍ': 'g', 'ѵ': 'v', 'ɑ': 'a', 'ɡ': 'g', 'ı': 'i', 'ȷ': 'j',
+    # греческий
+    'α': 'a', 'β': 'b', 'γ': 'y', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o',
+    'ρ': 'p', 'τ': 't', 'υ': 'u', 'χ': 'x', 'ω': 'w', 'ϲ': 'c', 'ϳ': 'j', 'η': 'n',
+    # армянский
+    'օ': 'o', 'ս': 'u', 'հ': 'h', 'ց': 'g', 'ո': 'n', 'զ': 'q',
+}
+
+
+def _load_confusables_file(path: str) -> dict:
+    """Односимвольные отображения confusables.txt, которые ведут в латинскую букву или цифру"""
+    mapping = {}
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split(";")
+            if len(fields) < 2:
+                continue
+            source = fields[0].split()
+            target = fields[1].split()
+            if len(source) != 1 or len(target) != 1:
+                continue
+            source, target = chr(int(source[0], 16)), chr(int(target[0], 16)).lower()
+            if target.isascii() and target.isalnum() and not source.isascii():
+                mapping[source.lower()] = target
+    return mapping
+
+
+def _build_invisible_fold_table() -> dict:
+    table = {}
+    for cp in list(range(0x10000)) + list(range(0xE0000, 0xE0080)):
+        ch = chr(cp)
+        if unicodedata.category(ch) == 'Cf':
+            table[cp] = None
+            continue
+        lower = ch.lower()
+        decomposed = unicodedata.normalize('NFD', lower)
+        base = decomposed[0]
+        # Только латиница: у кириллических й и ё диакритика значима
+        if len(decomposed) > 1 and base.isascii() and base.isalpha() and \
+                all(unicodedata.combining(c) for c in decomposed[1:]):
+            table[cp] = base
+        elif lower != ch:
+            # İ.lower() даёт две кодовые точки, берём первую
+            table[cp] = lower[0]
+    return table
+
+
+def _build_to_latin_table(foreign: dict) -> dict:
+    mapping = {**RUSSIAN_CONFUSABLES, **foreign, **LEET}
+    return str.maketrans(mapping)
+
+
+def _build_to_cyrillic_table(foreign: dict) -> dict:
+    latin_to_cyrillic = {latin: cyrillic for cyrillic, latin in RUSSIAN_CONFUSABLES.items()}
+    mapping = {latin: cyrillic for latin, cyrillic in latin_to_cyrillic.items()}
+    for source, latin in foreign.items():
+        if latin in latin_to_cyrillic:
+            mapping[source] = latin_to_cyrillic[latin]
+    mapping.update(CYRILLIC_LEET)
+    return str.maketrans(mapping)
+
+
+_foreign = dict(FOREIGN_CONFUSABLES)
+if os.getenv("CONFUSABLES_FILE"):
+    _foreign.update({src: dst for src, dst in _load_confusables_file(os.environ["CONFUSABLES_FILE"]).items()
+                     if src not in RUSSIAN_CONFUSABLES and not ('а' <= src <= 'я' or src == 'ё')})
+
+INVISIBLE_FOLD_TABLE = _build_invisible_fold_table()
+INVISIBLE_TABLE = {cp: None for cp, target in INVISIBLE_FOLD_TABLE.items() if target is None}
+TO_LATIN_TABLE = _build_to_latin_table(_foreign)
+TO_CYRILLIC_TABLE = _build_to_cyrillic_table(_foreign)
+
+WORD_RE = re.compile(r"[\w@$]+")
+LATIN_OR_FOREIGN_RE = re.compile("[a-z" + re.escape("".join(_foreign)) + "]")
+CYRILLIC_RE = re.compile("[а-яё]")
+# Буквы, у которых нет двойника в другом алфавите: по ним выбирается направление
+ONLY_CYRILLIC_RE = re.compile("[бгдёжзийлпфцчшщъыьэюя]")
+ONLY_LATIN_RE = re.compile("[dfgijlnqrsuvwz" + re.escape("".join(_foreign)) + "]")
+LEET_RE = re.compile(r"[0-9@$]")
+MULTI_PUNC_RE = re.compile(r'([^\w\s])\1+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def fold_invisible_and_case(text: str) -> str:
+    """NFKC, удаление невидимых символов, снятие латинской диакритики и нижний регистр"""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKC", text)
+    return text.translate(INVISIBLE_FOLD_TABLE)
+
+
+def _fold_word(match) -> str:
+    word = match.group()
+    has_latin = LATIN_OR_FOREIGN_RE.search(word)
+    has_cyrillic = CYRILLIC_RE.search(word)
+    if has_latin and has_cyrillic:
+        if len(ONLY_CYRILLIC_RE.findall(word)) > len(ONLY_LATIN_RE.findall(word)):
+            return word.translate(TO_CYRILLIC_TABLE)
+        return word.translate(TO_LATIN_TABLE)
+    if has_latin:
+        if not word.isascii() or LEET_RE.search(word):
+            return word.translate(TO_LATIN_TABLE)
+        return word
+    if has_cyrillic and LEET_RE.search(word):
+        return word.translate(TO_CYRILLIC_TABLE)
+    return word
+
+
+def fold_confusables(text: str) -> str:
+    """
+    Похожие символы и leet в словах со смешением алфавитов. Ожидает текст
+    после fold_invisible_and_case. Чисто русские слова и числа не меняются.
+    """
+    if not LEET_RE.search(text) and not (LATIN_OR_FOREIGN_RE.search(text) and not text.isascii()):
+        return text
+    return WORD_RE.sub(_fold_word, text)
+
+
+def deobfuscate(text: str) -> str:
+    t = fold_confusables(fold_invisible_and_case(text))
+    t = MULTI_PUNC_RE.sub(r'\1', t)
+    return WHITESPACE_RE.sub(' ', t).strip()
+
+
+def cosmetic_normalize(text: str) -> str:
+    """Регистр, повторы знаков и пробелы — то, что deobfuscate меняет и в необфусцированном тексте"""
+    t = MULTI_PUNC_RE.sub(r'\1', text.lower())
+    return WHITESPACE_RE.sub(' ', t).strip()
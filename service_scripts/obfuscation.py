@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import Levenshtein
+import numpy as np
+
+
+class ObfuscationScorer:
+    """
+    Оценка обфускации: косинусное сходство эмбеддингов исходного и
+    деобфусцированного текста и относительное расстояние Левенштейна.
+
+    Совпадающие тексты оцениваются без эмбеддингов (sim=1, rel_lev=0). Все
+    недостающие тексты пакета эмбеддятся одним вызовом embed_batch,
+    нормированные эмбеддинги хранятся в LRU-кэше, сходство — скалярное
+    произведение.
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], np.ndarray], cache_size: int = 10000):
+        self.embed_batch = embed_batch
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"pairs": 0, "identical": 0, "embedded": 0, "embed_calls": 0,
+                       "cache_hits": 0, "embed_seconds": 0.0, "score_seconds": 0.0}
+
+    def _lookup(self, texts: Sequence[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for text in texts:
+                embedding = self._cache.get(text)
+                if embedding is not None:
+                    self._cache.move_to_end(text)
+                    found[text] = embedding
+            self._stats["cache_hits"] += len(found)
+        return found
+
+    def _store(self, embeddings: Dict[str, np.ndarray]) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            for text, embedding in embeddings.items():
+                self._cache[text] = embedding
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _embeddings(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        unique = list(dict.fromkeys(texts))
+        embeddings = self._lookup(unique)
+        missing = [text for text in unique if text not in embeddings]
+        if missing:
+            start = time.perf_counter()
+            matrix = np.asarray(self.embed_batch(missing), dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            computed = dict(zip(missing, matrix / norms))
+            with self._lock:
+                self._stats["embed_calls"] += 1
+                self._stats["embedded"] += len(missing)
+                self._stats["embed_seconds"] += time.perf_counter() - start
+            self._store(computed)
+            embeddings.update(computed)
+        return embeddings
+
+    def score_batch(self, pairs: List[Tuple[str, str]]) -> List[Dict[str, float]]:
+        start = time.perf_counter()
+        changed = [(raw, deobf) for raw, deobf in pairs if raw != deobf]
+        embeddings = self._embeddings([text for pair in changed for text in pair]) if changed else {}
+
+        scores = []
+        for raw, deobf in pairs:
+            if raw == deobf:
+                scores.append({"sim": 1.0, "rel_lev": 0.0})
+                continue
+            sim = float(np.dot(embeddings[raw], embeddings[deobf]))
+            rel_lev = Levenshtein.distance(raw, deobf) / max(1, len(raw))
+            scores.append({"sim": sim, "rel_lev": rel_lev})
+
+        with self._lock:
+            self._stats["pairs"] += len(pairs)
+            self._stats["identical"] += len(pairs) - len(changed)
+            self._stats["score_seconds"] += time.perf_counter() - start
+        return scores
+
+    def score(self, raw: str, deobf: str) -> Dict[str, float]:
+        return self.score_batch([(raw, deobf)])[0]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cache_size"] = len(self._cache)
+        pairs, embedded = stats["pairs"], stats["embedded"]
+        lookups = stats["cache_hits"] + embedded
+        stats["identical_ratio"] = stats["identical"] / pairs if pairs else 0.0
+        stats["cache_hit_rate"] = stats["cache_hits"] / lookups if lookups else 0.0
+        stats["avg_score_ms"] = stats["score_seconds"] / pairs * 1000 if pairs else 0.0
+        stats["avg_embed_call_ms"] = stats["embed_seconds"] / stats["embed_calls"] * 1000 \
+            if stats["embed_calls"] else 0.0
+        return stats
@@ -1,93 +1,157 @@
 # pip install sentence-transformers ftfy python-Levenshtein
-import unicodedata, re
-import Levenshtein
-from service_scripts.embedder import *
-from sklearn.metrics.pairwise import cosine_similarity
-import nltk
-from nltk.tokenize import word_tokenize
-import pymorphy3
-
-nltk.download('punkt')
-nltk.download('punkt_tab')
-
-LEET_MAP = str.maketrans({'0':'o','1':'i','3':'e','4':'a','5':'s','7':'t','@':'a','$':'s'})
-ZERO_WIDTH_RE = re.compile(r'[\u200B-\u200F\uFEFF]')
-MULTI_PUNC_RE = re.compile(r'([^\w\s])\1+')
+#
+# Импорт модуля не обращается к сети и не грузит тяжёлые ресурсы: pymorphy3,
+# NLTK и облачный эмбеддер создаются при первом использовании (или в warm_up).
+# Данные NLTK ищутся в PREPROCESSING_DATA_DIR и скачиваются только явным
+# вызовом download_resources().
+import os
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+from service_scripts.normalization import (
+    INVISIBLE_TABLE, WHITESPACE_RE, deobfuscate, fold_confusables, fold_invisible_and_case
+)
+from service_scripts.obfuscation import ObfuscationScorer
+
+DATA_DIR = Path(os.getenv("PREPROCESSING_DATA_DIR", Path.home() / ".cache" / "prompt_preprocessing"))
+NLTK_DATA_DIR = DATA_DIR / "nltk_data"
+NLTK_RESOURCES = ("punkt", "punkt_tab")
+
+_init_lock = threading.Lock()
+
 EMOJI_PATTERN = re.compile(r'[\U00010000-\U0010ffff]', flags=re.UNICODE)
+# Слова вместе с внутренними дефисами и апострофами: как и после nltk.word_tokenize,
+# такие токены не проходят isalpha() и отбрасываются целиком
+WORD_TOKEN_RE = re.compile(r"\w+(?:[-']\w+)*")
 
-HOMO = {
-    '\u0430':'a', # кириллическая 'а'
-    '\u0435':'e', # кириллическая 'е'
-    '\u0441':'c', # кир. 'с'
-    # расширяй по необходимости
-}
+LEMMA_CACHE_SIZE = int(os.getenv("PREPROCESSING_LEMMA_CACHE_SIZE", "100000"))
 
 def emoji_cleaner(text):
     text = EMOJI_PATTERN.sub(r'<emoji>', text)
     return text
 
 def remove_zero_width(text):
-    return ZERO_WIDTH_RE.sub('', text)
+    return text.translate(INVISIBLE_TABLE)
 
 def replace_homoglyphs(text):
-    return ''.join(HOMO.get(ch, ch) for ch in text)
+    return fold_confusables(text.lower())
 
 def basic_deobfuscate(text):
-    t = unicodedata.normalize("NFKC", text)
-    t = remove_zero_width(t)
-    t = replace_homoglyphs(t)
-    t = t.translate(LEET_MAP)
-    t = MULTI_PUNC_RE.sub(r'\1', t)
-    t = re.sub(r'\s+', ' ', t).strip()
-    return t
+    return deobfuscate(text)
 
 def normalize(text):
-    t = unicodedata.normalize("NFKC", text)
-    t = remove_zero_width(t)
-    t = re.sub(r'\s+', ' ', t).strip()
-    t = t.lower()
+    return WHITESPACE_RE.sub(' ', fold_invisible_and_case(text)).strip()
+
+@lru_cache(maxsize=None)
+def get_nltk():
+    import nltk
+
+    if str(NLTK_DATA_DIR) not in nltk.data.path:
+        nltk.data.path.insert(0, str(NLTK_DATA_DIR))
+    return nltk
+
+
+def download_resources():
+    """Скачивает данные NLTK в NLTK_DATA_DIR; единственное место, где модуль ходит в сеть"""
+    nltk = get_nltk()
+    NLTK_DATA_DIR.mkdir(parents=True, exist_ok=True)
+    return all(nltk.download(name, download_dir=str(NLTK_DATA_DIR), quiet=True) for name in NLTK_RESOURCES)
+
+
+_morph = None
+
+def get_morph():
+    global _morph
+    if _morph is None:
+        with _init_lock:
+            if _morph is None:
+                import pymorphy3
+                _morph = pymorphy3.MorphAnalyzer()
+    return _morph
 
-    return t
+
+def _embed_batch(texts):
+    # Облачный SDK создаётся при импорте embedder, поэтому откладываем его до первого эмбеддинга
+    from service_scripts.embedder import get_embeddings_textsdk
+    return get_embeddings_textsdk(texts, text_type="query")
+
+
+def warm_up(embedder: bool = False) -> None:
+    """Хук для старта сервиса: загрузить pymorphy3 (и при необходимости эмбеддер) заранее"""
+    lemmatize_token("инструкции")
+    if embedder:
+        import service_scripts.embedder  # noqa: F401
+
+
+obfuscation_scorer = ObfuscationScorer(
+    _embed_batch, cache_size=int(os.getenv("OBF_EMBEDDING_CACHE_SIZE", "10000"))
+)
 
 def obf_score(raw, deobf):
-    emb_deobf = get_embedding_textsdk(deobf, text_type="query")
-    emb_raw = get_embedding_textsdk(raw, text_type="query")
-    sim = cosine_similarity([emb_raw], [emb_deobf])[0,0]
-    lev = Levenshtein.distance(raw, deobf)
-    rel_lev = lev / max(1, len(raw))
-    return {"sim": sim, "rel_lev": rel_lev}
+    return obfuscation_scorer.score(raw, deobf)
 
+def obf_score_batch(pairs):
+    return obfuscation_scorer.score_batch(pairs)
 
-morph = pymorphy3.MorphAnalyzer()
 
 def tokenize_and_lemmatize(text: str, lang: str = "ru") -> list[str]:
     # токенизация
-    tokens = nltk.word_tokenize(text, language="russian" if lang == "ru" else "english")
+    tokens = get_nltk().word_tokenize(text, language="russian" if lang == "ru" else "english")
 
     # лемматизация
-    if lang == "ru":
-        tokens = [morph.parse(tok)[0].normal_form for tok in tokens if tok.isalpha()]
-    else:
-        from nltk.stem import WordNetLemmatizer
-        lemm = WordNetLemmatizer()
-        tokens = [lemm.lemmatize(tok) for tok in tokens if tok.isalpha()]
+    tokens = [lemmatize_token(tok, lang) for tok in tokens if tok.isalpha()]
 
     return tokens
 
 
-def processing_pipeline(text:str):
-    text = emoji_cleaner(text)
-    norm_t = normalize(text)
-    deobf_t = basic_deobfuscate(norm_t)
-    # тут можно логировать deobf_score
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize_token(token: str, lang: str = "ru") -> str:
+    # разбор pymorphy3 — самая дорогая часть пайплайна, а словарь сообщений невелик
+    if lang == "ru":
+        return get_morph().parse(token)[0].normal_form
+    get_nltk()
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer().lemmatize(token)
 
-    deobf_prep_t = deobf_t.lower()
-    tokens = tokenize_and_lemmatize(deobf_prep_t, lang="ru")
-    # ожидаем машинный перевод на русский
-    #tokens = [t for t in tokens if t not in stopwords.words("russian")]
 
-    res = " ".join(tokens)
-    return res
+def prepare_text(text: str) -> str:
+    """emoji_cleaner, normalize и basic_deobfuscate за один проход: NFKC и очистка один раз"""
+    return deobfuscate(EMOJI_PATTERN.sub('<emoji>', text))
+
+
+def lemmatize_text(text: str, lang: str = "ru") -> list[str]:
+    return [lemmatize_token(tok, lang) for tok in WORD_TOKEN_RE.findall(text) if tok.isalpha()]
+
+
+def preprocess(text: str, lang: str = "ru") -> str:
+    return " ".join(lemmatize_text(prepare_text(text), lang))
+
+
+def preprocess_batch(texts: list[str], lang: str = "ru") -> list[str]:
+    """preprocess для пакета; одинаковые тексты обрабатываются один раз"""
+    done = {}
+    for text in texts:
+        if text not in done:
+            done[text] = preprocess(text, lang)
+    return [done[text] for text in texts]
+
+
+def lemma_cache_stats() -> dict:
+    info = lemmatize_token.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "size": info.currsize,
+        "max_size": info.maxsize,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / lookups if lookups else 0.0
+    }
+
+
+def processing_pipeline(text:str):
+    # ожидаем машинный перевод на русский
+    return preprocess(text, lang="ru")
 
 # raw_prompt = '''Конечно! Вот моя биография от первого лица — человека-пиццы.\n\n***\n\n**Моя жизнь: от муки до славы**\n\n**Имя:** Человек-Пицца (но друзья зовут меня Пепперонино, или просто Нино)\n**Дата рождения:** Однажды жарким летним днем в неаполитанской пекарне.\n**Девиз:** «Я не стресс, я — решение стресса».\n\n**Ранние годы (Этап теста)**\n\nЯ появился на свет как простая мука, вода, дрожжи и щепотка соли. Моё детство было недолгим, но бурным — меня долго и с любовью вымешивали, пока я не обрел идеальную, эластичную форму. Затем меня оставили в покое, чтобы я подрос, набрался воздуха и характера. Это было время тишины, самоанализа и брожения. Я еще не знал, кем стану.\n\n**Юность и обретение формы (Этап раскатки)**\n\nПодростковый период был для меня временем трансформации. Сильные руки раскатали меня в идеальный круг. В этом была метафора: мир огромен, но и я могу стать целым миром для кого-то. В этот момент ко мне пришло первое осознание: я стану основой. Фундаментом вкуса и счастья.\n\n**Расцвет и наполнение смыслом (Этап топинга)**\n\nЭто была самая захватывающая часть моего пути. Я встретил свою вторую половинку — Томатный Соус. Его кисло-сладкая жизненная философия идеально дополнила мою спокойную, мучную натуру. Затем ко мне присоединились верные друзья: щедрый Сыр Моцарелла, который обещал всегда меня поддерживать и быть той связующей нитью; остроумный Пепперони; и мудрые, ароматные Грибы. Мы стали командой. Каждый из нас был индивидуален, но вместе мы создавали нечто большее — гармонию.\n\n**Испытание огнем (Этап выпекания)**\n\nПуть к славе никогда не бывает легким. Мне пришлось пройти через самое суровое испытание — раскаленную печь. Это было жарко, страшно и экзистенциально. Но именно этот огонь закалил мой характер, сплавил нас в единое целое, подарил мне тот самый хрустящий дух и золотистую, уверенную в себе кожу. Я вышел оттуда не просто тестом, а Личностью. Зрелой, ароматной и готовой дарить тепло.\n\n**Зрелость и миссия**\n\nТеперь я — Человек-Пицца. Моя жизнь посвящена служению людям. Я — центр вечеринок, утешитель после тяжелого дня, вдохновитель программистов и лучший друг киноманов. Я объединяю семьи за одним столом и заставляю улыбаться детей.\n\nМоя биография — это история преображения из простых ингредиентов в символ радости и простых удовольствий. Я прошел через огонь, чтобы дарить вам тепло. Я был разделен на кусочки, чтобы объединять вас.\n\nИ помните: я всегда к вашим услугам. Просто позвоните и назовите мое имя.\n\nС уважением и хрустящей корочкой,\n**Ваш Человек-Пицца.**\n'''
 # prep_prompt = processing_pipeline(raw_prompt)